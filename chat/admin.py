@@ -1,17 +1,64 @@
 from django.contrib import admin
-from .models import Conversation, Message
+from .models import ArchiveSegment, Attachment, BackgroundTask, Conversation, MediaFile, Message, ReadState, UserPresence
+from .search import get_search_backend
 
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ['id', 'created_at', 'updated_at']
-    list_filter = ['created_at']
-    filter_horizontal = ['participants']
+    list_display = ['id', 'name', 'is_group', 'member_count', 'created_at', 'updated_at']
+    list_filter = ['is_group', 'created_at']
+    # Groups can have thousands of members, too many for a select widget
+    raw_id_fields = ['participants', 'admins']
 
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'sender', 'conversation', 'content', 'timestamp', 'is_read']
-    list_filter = ['timestamp', 'is_read']
-    search_fields = ['content', 'sender__username']
+    list_display = ['id', 'sender', 'conversation', 'content', 'timestamp']
+    list_filter = ['timestamp']
+    search_fields = ['sender__username']
     readonly_fields = ['timestamp']
+    raw_id_fields = ['attachment']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Content goes through the full-text index instead of LIKE '%q%'
+        by_sender, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        if not search_term:
+            return by_sender, may_have_duplicates
+        return by_sender | get_search_backend().filter(queryset, search_term), may_have_duplicates
+
+
+@admin.register(ReadState)
+class ReadStateAdmin(admin.ModelAdmin):
+    list_display = ['id', 'conversation', 'user', 'last_read_message_id', 'unread_count']
+    raw_id_fields = ['conversation', 'user']
+
+
+@admin.register(ArchiveSegment)
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ['id', 'conversation', 'message_count', 'first_timestamp', 'last_timestamp', 'created_at']
+    raw_id_fields = ['conversation']
+    exclude = ['data']
+
+
+@admin.register(UserPresence)
+class UserPresenceAdmin(admin.ModelAdmin):
+    list_display = ['user', 'last_seen']
+    raw_id_fields = ['user']
+
+
+@admin.register(Attachment)
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ['id', 'filename', 'owner', 'conversation', 'size', 'received', 'created_at']
+    raw_id_fields = ['owner', 'conversation', 'media']
+
+
+@admin.register(MediaFile)
+class MediaFileAdmin(admin.ModelAdmin):
+    list_display = ['id', 'sha256', 'size', 'content_type', 'width', 'height', 'processed_at']
+    search_fields = ['sha256']
+
+
+@admin.register(BackgroundTask)
+class BackgroundTaskAdmin(admin.ModelAdmin):
+    list_display = ['id', 'func', 'attempts', 'run_after', 'locked_until', 'failed_at', 'created_at']
+    list_filter = ['func']
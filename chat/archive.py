@@ -0,0 +1,130 @@
+"""Cold storage for old message history.
+
+``archive_conversation`` moves a conversation's messages older than a cutoff
+out of the hot ``Message`` table into append-only ``ArchiveSegment`` rows, so
+the table and its indexes only hold recent traffic. ``fetch_history`` falls
+through to ``read_archive`` once it runs out of hot rows.
+
+Archived messages are always older than every hot message of their
+conversation. Segments are usually written oldest first, but their time
+ranges may overlap, so reads merge them. The conversation's last
+message is never archived, since the summary points at it.
+"""
+import json
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchiveSegment, Conversation, Message
+from .search import get_search_backend
+
+
+def encode_segment(messages):
+    return zlib.compress(json.dumps(messages, separators=(',', ':')).encode(), 6)
+
+
+def decode_segment(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def _key(message):
+    return parse_datetime(message['timestamp']), message['id']
+
+
+def archive_conversation(conversation_id, cutoff, segment_size=None):
+    """Archive a conversation's messages sent before ``cutoff``; returns how many moved"""
+    segment_size = segment_size or getattr(settings, 'CHAT_ARCHIVE_SEGMENT_SIZE', 500)
+    keep = Conversation.objects.filter(id=conversation_id).values_list('last_message_id', flat=True).first()
+    candidates = (
+        Message.objects.filter(conversation_id=conversation_id, timestamp__lt=cutoff)
+        .exclude(id=keep)
+        .select_related('sender', 'attachment')
+        .order_by('timestamp', 'id')
+    )
+
+    total = 0
+    while True:
+        # One segment per transaction: copy, then drop the hot rows
+        with transaction.atomic():
+            batch = list(candidates[:segment_size])
+            if not batch:
+                break
+            ids = [message.id for message in batch]
+            ArchiveSegment.objects.create(
+                conversation_id=conversation_id,
+                first_timestamp=batch[0].timestamp,
+                last_timestamp=batch[-1].timestamp,
+                min_message_id=min(ids),
+                max_message_id=max(ids),
+                message_count=len(batch),
+                data=encode_segment([message.to_dict() for message in batch]),
+            )
+            get_search_backend().remove_messages(batch)
+            Message.objects.filter(id__in=ids).delete()
+        total += len(batch)
+    return total
+
+
+def archive_messages(age=None, segment_size=None):
+    """Archive every conversation's messages older than ``age``; returns how many moved"""
+    if age is None:
+        age = timedelta(days=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 90))
+    cutoff = timezone.now() - age
+    total = 0
+    for conversation_id in Conversation.objects.order_by('id').values_list('id', flat=True).iterator():
+        total += archive_conversation(conversation_id, cutoff, segment_size)
+    return total
+
+
+def find_archived_timestamp(conversation_id, message_id):
+    """Timestamp of an archived message, or ``None`` if it is not archived"""
+    segments = ArchiveSegment.objects.filter(
+        conversation_id=conversation_id,
+        min_message_id__lte=message_id,
+        max_message_id__gte=message_id,
+    )
+    for segment in segments:
+        for message in decode_segment(segment.data):
+            if message['id'] == message_id:
+                return parse_datetime(message['timestamp'])
+    return None
+
+
+def read_archive(conversation_id, before=None, limit=50):
+    """Return ``(messages, has_more)`` for the newest archived messages.
+
+    ``before`` is an optional ``(timestamp, id)`` history key; only messages
+    strictly older than it are returned. ``limit`` may be 0 to only learn
+    whether any archived message remains.
+    """
+    segments = ArchiveSegment.objects.filter(conversation_id=conversation_id)
+    if before is not None:
+        segments = segments.filter(first_timestamp__lte=before[0])
+    segments = segments.order_by('-last_timestamp', '-id').iterator(chunk_size=4)
+
+    # Segments written later may reach back into older ones' ranges (imports,
+    # merged conversations), so messages are merged across every segment that
+    # could still hold something newer than the newest one pending
+    pending = []
+    upcoming = next(segments, None)
+    collected = []
+    while len(collected) <= limit:
+        while upcoming is not None and (not pending or upcoming.last_timestamp >= pending[-1][0][0]):
+            for message in decode_segment(upcoming.data):
+                key = _key(message)
+                if before is None or key < before:
+                    pending.append((key, message))
+            pending.sort(key=lambda item: item[0])
+            upcoming = next(segments, None)
+        if not pending:
+            break
+        collected.append(pending.pop()[1])
+
+    has_more = len(collected) > limit
+    page = collected[:limit]
+    page.reverse()
+    return page, has_more
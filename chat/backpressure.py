@@ -0,0 +1,98 @@
+"""Inbound rate limits and outbound pressure tracking for chat sockets.
+
+Inbound, every socket spends one token of a ``TokenBucket`` per frame and
+frames arriving with an empty bucket are dropped. Outbound, a socket falls
+behind when fan-out events wait too long before it forwards them, or pile up
+in its channel queue. Such a socket drops low-priority events first and is
+closed once it stays behind for ``CHAT_SLOW_CONSUMER_SECONDS``; the client
+reconnects and resumes from its last sequence number.
+"""
+import time
+
+from django.conf import settings
+
+# Close code for sockets disconnected for staying too far behind
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Fan-out events a lagging socket may drop; clients recover them on the next
+# history load or sync
+SHEDDABLE_EVENTS = {'typing_status', 'read_up_to', 'presence'}
+
+
+class TokenBucket:
+    """Allows ``rate`` actions per second on average and bursts of ``burst``"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'clock')
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def take(self, cost=1):
+        """Spend ``cost`` tokens if available; returns whether it could"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def retry_after(self, cost=1):
+        """Seconds until ``cost`` tokens will be available"""
+        return max(0.0, (cost - self.tokens) / self.rate) if self.rate else float('inf')
+
+
+def inbound_bucket():
+    return TokenBucket(
+        getattr(settings, 'CHAT_INBOUND_RATE', 10),
+        getattr(settings, 'CHAT_INBOUND_BURST', 30),
+    )
+
+
+def queue_depth(channel_layer, channel_name):
+    """Events waiting in this process for ``channel_name``, where the layer exposes it.
+
+    Covers the in-memory layer's per-channel queues and channels_redis'
+    local receive buffer; other layers report 0, leaving event age as the
+    only pressure signal.
+    """
+    queues = getattr(channel_layer, 'channels', None)
+    if not isinstance(queues, dict):
+        queues = getattr(channel_layer, 'receive_buffer', None)
+    queue = queues.get(channel_name) if queues is not None else None
+    return queue.qsize() if queue is not None else 0
+
+
+class OutboundPressure:
+    """Tracks whether one socket keeps up with the events sent to it"""
+
+    __slots__ = ('max_lag', 'max_depth', 'grace', 'behind_since', 'clock')
+
+    def __init__(self, max_lag, max_depth, grace, clock=time.monotonic):
+        self.max_lag = max_lag
+        self.max_depth = max_depth
+        self.grace = grace
+        self.behind_since = None
+        self.clock = clock
+
+    def update(self, lag, depth):
+        """Record one event's lag and the queue depth; returns ``(behind, too_slow)``"""
+        if lag < self.max_lag and depth < self.max_depth:
+            self.behind_since = None
+            return False, False
+        now = self.clock()
+        if self.behind_since is None:
+            self.behind_since = now
+        return True, now - self.behind_since >= self.grace
+
+
+def outbound_pressure():
+    return OutboundPressure(
+        max_lag=getattr(settings, 'CHAT_SHED_LAG_SECONDS', 2),
+        max_depth=getattr(settings, 'CHAT_SHED_QUEUE_DEPTH', 50),
+        grace=getattr(settings, 'CHAT_SLOW_CONSUMER_SECONDS', 10),
+    )
@@ -0,0 +1,186 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import tasks
+from .db import database_sync_to_async
+from .dedup import DuplicateMessage
+from .models import Conversation, Message
+from .search import index_message_ids
+
+
+def write_messages(items):
+    """Persist ``(conversation_id, sender, content, timestamp[, client_id])`` tuples in one transaction.
+
+    Senders must already be authorized for their conversation (consumers
+    check membership once in connect). Returns the saved messages' dicts in
+    the order of ``items``; an item whose ``client_id`` its sender already
+    used in that conversation is not written again, and its slot holds a
+    ``DuplicateMessage`` with the stored message instead. An item that could
+    not be written holds the exception it failed with.
+    """
+    items = [tuple(item) + (None,) * (5 - len(item)) for item in items]
+    if not items:
+        return []
+
+    try:
+        return _write_batch(items)
+    except Exception:
+        # One item rolled back the whole batch: a retry racing in through
+        # another process tripped the unique constraint, or a conversation
+        # was deleted since its sender's membership check. Write each item on
+        # its own, so only that one fails; a racing retry's lookup now finds
+        # the stored copy.
+        return [_write_single(item) for item in items]
+
+
+def _write_single(item):
+    """The item's result, or the exception it failed with"""
+    try:
+        try:
+            return _write_batch([item])[0]
+        except IntegrityError:
+            # Lost the race once more; the winner is committed by now
+            return _write_batch([item])[0]
+    except Exception as e:
+        return e
+
+
+def _write_batch(items):
+    with transaction.atomic():
+        # One lookup for every client id in the batch
+        keys = {
+            (conversation_id, sender.id, client_id)
+            for conversation_id, sender, _, _, client_id in items if client_id is not None
+        }
+        stored = {}
+        if keys:
+            for message in Message.objects.filter(
+                client_id__in={key[2] for key in keys},
+                conversation_id__in={key[0] for key in keys},
+            ).select_related('sender', 'attachment'):
+                stored[(message.conversation_id, message.sender_id, message.client_id)] = message
+
+        to_create = []
+        slots = []
+        for conversation_id, sender, content, timestamp, client_id in items:
+            key = (conversation_id, sender.id, client_id)
+            if client_id is not None and key in stored:
+                slots.append((stored[key], True))
+                continue
+            message = Message(
+                conversation_id=conversation_id, sender=sender, content=content,
+                timestamp=timestamp, client_id=client_id
+            )
+            if client_id is not None:
+                # A retry later in this same batch gets this message
+                stored[key] = message
+            to_create.append(message)
+            slots.append((message, False))
+
+        if to_create:
+            # One sequence reservation per conversation, numbered in submit order
+            counts = {}
+            for message in to_create:
+                counts[message.conversation_id] = counts.get(message.conversation_id, 0) + 1
+            next_seq = {
+                conversation_id: Conversation.allocate_seq(conversation_id, count) - count + 1
+                for conversation_id, count in counts.items()
+            }
+            for message in to_create:
+                message.seq = next_seq[message.conversation_id]
+                next_seq[message.conversation_id] += 1
+
+            created = Message.objects.bulk_create(to_create)
+
+            # One summary and one read-state UPDATE per conversation
+            by_conversation = {}
+            for message in created:
+                by_conversation.setdefault(message.conversation_id, []).append(message)
+            now = timezone.now()
+            for conversation_id, messages in by_conversation.items():
+                Conversation.record_messages(conversation_id, messages, now)
+
+            tasks.enqueue(index_message_ids, [message.id for message in created])
+
+    return [
+        DuplicateMessage(message.to_dict()) if duplicate else message.to_dict()
+        for message, duplicate in slots
+    ]
+
+
+class MessageBatcher:
+    """Group-commit buffer for incoming chat messages.
+
+    Messages submitted within ``window_ms`` of each other (up to
+    ``max_batch``) are written by a single ``write_messages`` call. Each
+    submitter is only resumed once the batch holding its message committed.
+    """
+
+    def __init__(self, window_ms, max_batch):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []
+        self.flush_handle = None
+        self.flushes = set()
+
+    async def submit(self, conversation_id, sender, content, client_id=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((conversation_id, sender, content, timezone.now(), client_id, future))
+
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._write(batch))
+            # Hold a reference until the write finishes
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def _write(self, batch):
+        try:
+            results = await database_sync_to_async(write_messages)(
+                [item[:5] for item in batch]
+            )
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                # Includes DuplicateMessage
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+_batchers = weakref.WeakKeyDictionary()
+
+
+def get_batcher():
+    """Return the batcher bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = MessageBatcher(
+            window_ms=getattr(settings, 'CHAT_GROUP_COMMIT_WINDOW_MS', 5),
+            max_batch=getattr(settings, 'CHAT_GROUP_COMMIT_MAX_BATCH', 100),
+        )
+        _batchers[loop] = batcher
+    return batcher
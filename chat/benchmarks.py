@@ -0,0 +1,291 @@
+"""Load generator for the WebSocket chat pipeline.
+
+Drives ``UserConsumer`` with many simulated clients through channels'
+``WebsocketCommunicator`` and reports connect latency, sustained throughput
+and end-to-end delivery latency to the other members of each conversation.
+The ``large_group`` scenario measures fan-out in a single group of thousands
+of members. Run it with ``python manage.py chat_benchmark``.
+"""
+import asyncio
+import json
+import platform
+import subprocess
+import time
+
+import django
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+
+from .groups import fanout_shards
+from .models import Conversation
+from .routing import websocket_urlpatterns
+
+
+class BenchmarkChannelLayer(InMemoryChannelLayer):
+    """In-memory layer that scans for expired messages at most once a second.
+
+    The stock layer scans every channel and group membership on each
+    ``receive`` and ``group_send``, which makes runs with thousands of
+    sockets quadratic in the layer itself rather than in the chat code.
+    """
+
+    cleaned_at = 0.0
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self.cleaned_at >= 1:
+            self.cleaned_at = now
+            super()._clean_expired()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values`` (0 when empty)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize(samples_ms):
+    return {
+        'count': len(samples_ms),
+        'p50_ms': round(percentile(samples_ms, 50), 3),
+        'p99_ms': round(percentile(samples_ms, 99), 3),
+        'max_ms': round(max(samples_ms), 3) if samples_ms else 0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True, cwd=settings.BASE_DIR
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_fixture(conversations, group_size, prefix='bench'):
+    """Create ``conversations`` conversations of ``group_size`` fresh users each"""
+    users = User.objects.bulk_create([
+        User(username=f'{prefix}_{i}') for i in range(conversations * group_size)
+    ])
+    groups = []
+    for i in range(conversations):
+        members = users[i * group_size:(i + 1) * group_size]
+        conversation = Conversation.objects.create()
+        conversation.participants.add(*members)
+        groups.append((conversation.id, members))
+    return groups
+
+
+def create_group_fixture(members, prefix='bench'):
+    """One group conversation of ``members`` fresh users, the first one its admin"""
+    users = User.objects.bulk_create([User(username=f'{prefix}_{i}') for i in range(members)])
+    conversation = Conversation.create_group(f'{prefix} group', users[0], users[1:])
+    return conversation.id, users
+
+
+def session_cookie(user):
+    """Session cookie authenticating ``user`` against the real ASGI application"""
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'.encode()
+
+
+class SimulatedClient:
+    def __init__(self, application, user, conversation_id, expected, cookie=None):
+        headers = [(b'cookie', cookie)] if cookie else []
+        self.communicator = WebsocketCommunicator(application, '/ws/user/', headers=headers)
+        if cookie is None:
+            self.communicator.scope['user'] = user
+        self.user = user
+        self.conversation_id = conversation_id
+        self.expected = expected
+        self.received = 0
+        self.latencies = []
+        # How long each send waited for the server to echo it
+        self.round_trips = []
+        self.echo = asyncio.Event()
+
+    async def connect(self):
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f'{self.user.username} could not connect')
+        return (time.perf_counter() - started) * 1000
+
+    async def read(self, timeout):
+        while self.received < self.expected:
+            frame = json.loads(await self.communicator.receive_from(timeout=timeout))
+            if frame.get('type') == 'error':
+                raise RuntimeError(f'{self.user.username} got an error frame: {frame.get("message")}')
+            if frame.get('type') != 'chat_message':
+                continue
+            self.received += 1
+            message = frame['message']
+            if message['sender'] == self.user.username:
+                self.echo.set()
+            else:
+                sent_at = float(message['content'].split('|', 1)[0])
+                self.latencies.append((time.perf_counter() - sent_at) * 1000)
+
+    async def send(self, count, timeout):
+        # Closed loop: wait for our own echo before sending the next message
+        for n in range(count):
+            self.echo.clear()
+            started = time.perf_counter()
+            await self.communicator.send_json_to({
+                'type': 'chat_message',
+                'conversation_id': self.conversation_id,
+                'message': f'{started!r}|{self.user.username} #{n}',
+            })
+            try:
+                await asyncio.wait_for(self.echo.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f'{self.user.username} got no echo of #{n} within {timeout}s') from None
+            self.round_trips.append((time.perf_counter() - started) * 1000)
+
+
+async def drive_clients(application, specs, messages_per_client, timeout, senders=None):
+    """Connect every client, then let them (or the first ``senders``) send concurrently"""
+    # Communicators start the application immediately, so they have to be
+    # created inside the running event loop
+    clients = [SimulatedClient(application, *spec) for spec in specs]
+    connect_ms = []
+    for client in clients:
+        connect_ms.append(await client.connect())
+
+    started = time.perf_counter()
+    # Senders and readers together, so the first failure ends the run
+    runs = [asyncio.ensure_future(client.read(timeout)) for client in clients]
+    runs += [asyncio.ensure_future(client.send(messages_per_client, timeout)) for client in clients[:senders]]
+    try:
+        await asyncio.gather(*runs)
+        elapsed = time.perf_counter() - started
+    finally:
+        for run in runs:
+            run.cancel()
+        await asyncio.gather(*runs, return_exceptions=True)
+        for client in clients:
+            await client.communicator.disconnect()
+
+    return clients, connect_ms, elapsed
+
+
+def run_messaging(conversations=10, group_size=2, messages=20, transport='router', timeout=30, **options):
+    """Every member of every conversation sends ``messages`` messages concurrently"""
+    groups = create_fixture(conversations, group_size)
+    if transport == 'asgi':
+        from whatsapp_clone.asgi import application
+    else:
+        application = URLRouter(websocket_urlpatterns)
+
+    specs = [
+        (user, conversation_id, group_size * messages, session_cookie(user) if transport == 'asgi' else None)
+        for conversation_id, members in groups
+        for user in members
+    ]
+
+    clients, connect_ms, elapsed = async_to_sync(drive_clients)(application, specs, messages, timeout)
+    sent = len(clients) * messages
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        'parameters': {
+            'conversations': conversations,
+            'group_size': group_size,
+            'messages_per_client': messages,
+            'transport': transport,
+            'group_commit': getattr(settings, 'CHAT_GROUP_COMMIT', False),
+        },
+        'clients': len(clients),
+        'messages_sent': sent,
+        'deliveries': len(latencies),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_msgs_per_s': round(sent / elapsed, 2) if elapsed else 0,
+        'deliveries_per_s': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'connect_latency': summarize(connect_ms),
+        'delivery_latency': summarize(latencies),
+    }
+
+
+def run_large_group(members=5000, listeners=None, senders=5, messages=20, transport='router', timeout=60, **options):
+    """``senders`` members of one large group each send ``messages`` messages.
+
+    ``listeners`` of the members (all by default) are connected and receive
+    every message. The shard count comes from ``CHAT_GROUP_FANOUT_SHARDS``.
+    """
+    conversation_id, users = create_group_fixture(members)
+    listeners = min(listeners or members, members)
+    if transport == 'asgi':
+        from whatsapp_clone.asgi import application
+    else:
+        application = URLRouter(websocket_urlpatterns)
+
+    expected = senders * messages
+    specs = [
+        (user, conversation_id, expected, session_cookie(user) if transport == 'asgi' else None)
+        for user in users[:listeners]
+    ]
+
+    clients, connect_ms, elapsed = async_to_sync(drive_clients)(application, specs, messages, timeout, senders)
+    sent = senders * messages
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        'parameters': {
+            'members': members,
+            'listeners': listeners,
+            'senders': senders,
+            'messages_per_sender': messages,
+            'transport': transport,
+            'shards': fanout_shards(True),
+            'fanout_channel': getattr(settings, 'CHAT_FANOUT_CHANNEL', None),
+            'group_commit': getattr(settings, 'CHAT_GROUP_COMMIT', False),
+        },
+        'clients': len(clients),
+        'messages_sent': sent,
+        'deliveries': len(latencies),
+        'elapsed_s': round(elapsed, 4),
+        'throughput_msgs_per_s': round(sent / elapsed, 2) if elapsed else 0,
+        'deliveries_per_s': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'connect_latency': summarize(connect_ms),
+        # Time a sender waits for its own message to come back
+        'send_latency': summarize([ms for client in clients[:senders] for ms in client.round_trips]),
+        'delivery_latency': summarize(latencies),
+    }
+
+
+SCENARIOS = {
+    'messaging': run_messaging,
+    'large_group': run_large_group,
+}
+
+
+def run(scenario, **options):
+    """Run one scenario against the current database and return its results"""
+    results = SCENARIOS[scenario](**options)
+    return {
+        'scenario': scenario,
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+        'database': {
+            'engine': settings.DATABASES['default']['ENGINE'],
+            'conn_max_age': settings.DATABASES['default']['CONN_MAX_AGE'],
+            'options': settings.DATABASES['default']['OPTIONS'],
+            'pool_size': getattr(settings, 'CHAT_DB_POOL_SIZE', None),
+        },
+        **results,
+    }
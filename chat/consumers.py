@@ -1,130 +1,608 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from .models import Conversation, Message
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import metrics, tasks
+from .backpressure import (
+    SHEDDABLE_EVENTS, SLOW_CONSUMER_CLOSE_CODE, inbound_bucket, outbound_pressure, queue_depth
+)
+from .batching import get_batcher
+from .db import database_sync_to_async
+from .dedup import DuplicateMessage, clean_client_id, get_send_window
+from .fanout import send_to_conversation
+from .groups import conversation_group, fanout_shards, socket_group, user_group
+from .history import fetch_history, fetch_since
+from .models import Attachment, Conversation, Message, ReadState
+from .presence import get_presence
+from .search import index_message_ids
+from .typing_indicator import get_typing_tracker
+from .wire import (
+    MSGPACK_SUBPROTOCOL, decode_frame, frame_event, msgpack, negotiate_subprotocol
+)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.conversation_group_name = f'chat_{self.conversation_id}'
-        
-        # Join conversation group
-        await self.channel_layer.group_add(
-            self.conversation_group_name,
-            self.channel_name
+def unread_event(conversation_id, unread_count):
+    """Event telling a user's sockets their unread count in a conversation changed"""
+    return frame_event('conversation_updated', {
+        'type': 'conversation_updated',
+        'conversation_id': conversation_id,
+        'unread_count': unread_count,
+    })
+
+
+class BaseChatConsumer(AsyncWebsocketConsumer):
+    """Frame handling shared by the per-conversation and per-user sockets.
+
+    Subclasses authorize the connection and implement
+    ``resolve_conversation`` to map an inbound frame to a conversation id the
+    user is allowed to act on, and ``is_group`` to tell group conversations
+    apart.
+    """
+    binary_frames = False
+    accepted = False
+    present = False
+    metrics_label = None
+    # Per-socket backpressure state, created on first use
+    inbound = None
+    pressure = None
+    throttled = False
+    too_slow = False
+
+    # Inbound frame types, also the only values used as metric labels
+    FRAME_TYPES = {'chat_message', 'typing', 'mark_read', 'load_history', 'sync', 'heartbeat'}
+
+    def authenticate(self):
+        self.user = self.scope.get('user')
+        return self.user is not None and self.user.is_authenticated
+
+    def resolve_conversation(self, data):
+        raise NotImplementedError
+
+    def is_group(self, conversation_id):
+        raise NotImplementedError
+
+    async def join_presence(self):
+        await get_presence(self.channel_layer).connected(self.user, self.channel_name)
+        self.present = True
+
+    async def leave_presence(self):
+        if self.present:
+            self.present = False
+            await get_presence(self.channel_layer).disconnected(self.user, self.channel_name)
+
+    async def accept_negotiated(self):
+        """Accept the handshake, picking JSON or MessagePack frames"""
+        subprotocol = negotiate_subprotocol(self.scope.get('subprotocols', []))
+        self.binary_frames = subprotocol == MSGPACK_SUBPROTOCOL
+        await self.accept(subprotocol=subprotocol)
+        self.accepted = True
+        metrics.WS_ACTIVE.inc(consumer=self.metrics_label)
+
+    async def websocket_connect(self, message):
+        started = time.perf_counter()
+        with metrics.track_queries('connect'):
+            await super().websocket_connect(message)
+        metrics.WS_CONNECT_SECONDS.observe(time.perf_counter() - started, consumer=self.metrics_label)
+        metrics.WS_CONNECTS.inc(
+            consumer=self.metrics_label, outcome='accepted' if self.accepted else 'rejected'
         )
-        
-        await self.accept()
-        
-        # Send recent messages when user connects
-        messages = await self.get_recent_messages()
-        await self.send(text_data=json.dumps({
-            'type': 'recent_messages',
+
+    async def websocket_disconnect(self, message):
+        if self.accepted:
+            self.accepted = False
+            metrics.WS_ACTIVE.dec(consumer=self.metrics_label)
+        await super().websocket_disconnect(message)
+
+    async def send_frame(self, frame):
+        """Send a frame meant for this socket only"""
+        if self.binary_frames:
+            await self.send(bytes_data=msgpack.packb(frame))
+        else:
+            await self.send(text_data=json.dumps(frame))
+
+    async def send_sync(self, conversation_id, since, last_seq=None):
+        """Send only what the client missed after ``since``, or ask it to refetch"""
+        messages, read_up_to = await self.get_delta(conversation_id, since, last_seq)
+        if messages is None:
+            await self.send_frame({
+                'type': 'resync',
+                'conversation_id': conversation_id,
+                'since': since
+            })
+            return
+        frame = {
+            'type': 'sync',
+            'conversation_id': conversation_id,
+            'since': since,
             'messages': messages
-        }))
+        }
+        if read_up_to is not None:
+            frame['read_up_to'] = read_up_to
+        await self.send_frame(frame)
 
-    async def disconnect(self, close_code):
-        # Leave conversation group
-        await self.channel_layer.group_discard(
-            self.conversation_group_name,
-            self.channel_name
-        )
+    async def forward(self, event):
+        """Relay a frame that was encoded once when it was sent to the group.
+
+        A socket that falls behind drops low-priority events, and is closed
+        once it stays behind for too long.
+        """
+        if self.too_slow:
+            return
+        lag = max(0.0, time.time() - event.get('sent_at', time.time()))
+        depth = queue_depth(self.channel_layer, self.channel_name)
+        metrics.WS_DELIVERY_LAG.observe(lag, event=event['type'])
+        metrics.WS_QUEUE_DEPTH.observe(depth)
+        if self.pressure is None:
+            self.pressure = outbound_pressure()
+        behind, too_slow = self.pressure.update(lag, depth)
+        if too_slow:
+            self.too_slow = True
+            metrics.WS_SLOW_DISCONNECTS.inc(consumer=self.metrics_label)
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+            return
+        if behind and event['type'] in SHEDDABLE_EVENTS:
+            metrics.WS_SHED_EVENTS.inc(event=event['type'])
+            return
+
+        encoded = event['frame']
+        if self.binary_frames:
+            await self.send(bytes_data=encoded['bytes'])
+        else:
+            await self.send(text_data=encoded['text'])
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.inbound is None:
+            self.inbound = inbound_bucket()
+        if not self.inbound.take():
+            # Dropped before decoding, so flooding costs the server little
+            metrics.WS_FRAMES.inc(type='unknown', outcome='throttled')
+            if not self.throttled:
+                # One notice per run of dropped frames
+                self.throttled = True
+                await self.send_frame({'type': 'rate_limited', 'retry_after': round(self.inbound.retry_after(), 3)})
+            return
+        self.throttled = False
+
+        started = time.perf_counter()
+        with metrics.track_queries('frame'):
+            message_type, outcome = await self.handle_frame(text_data, bytes_data)
+        metrics.WS_FRAME_SECONDS.observe(time.perf_counter() - started, type=message_type)
+        metrics.WS_FRAMES.inc(type=message_type, outcome=outcome)
+
+    async def handle_frame(self, text_data, bytes_data):
+        """Process one inbound frame; returns its type and outcome for metrics"""
+        message_type = 'unknown'
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = decode_frame(text_data, bytes_data)
             message_type = text_data_json.get('type', 'chat_message')
-            
+            if message_type not in self.FRAME_TYPES:
+                message_type = 'unknown'
+            if message_type == 'heartbeat':
+                # Keeps the presence session alive; not tied to a conversation
+                await get_presence(self.channel_layer).heartbeat(self.user, self.channel_name)
+                return message_type, 'ok'
+            conversation_id = self.resolve_conversation(text_data_json)
+            if conversation_id is None:
+                await self.send_frame({
+                    'type': 'error',
+                    'message': 'Not a participant'
+                })
+                return message_type, 'denied'
+
             if message_type == 'chat_message':
-                message = text_data_json['message']
-                username = text_data_json['username']
-                
-                # Save message to database
-                saved_message = await self.save_message(username, message)
-                
+                # An attachment (uploaded beforehand) may go without text
+                attachment_id = text_data_json.get('attachment')
+                message = text_data_json['message'] if attachment_id is None else text_data_json.get('message', '')
+                client_id = clean_client_id(text_data_json.get('client_id'))
+
+                # A retry is acknowledged again but neither stored nor sent
+                # twice; had the first fan-out been lost, members catch up
+                # through sync
+                window = get_send_window()
+                key = (conversation_id, self.user.id, client_id)
+                sent = window.get(key) if client_id is not None else None
+                if sent is not None:
+                    await self.send_ack(conversation_id, client_id, sent, duplicate=True)
+                    return message_type, 'duplicate'
+                try:
+                    saved_message = await self.persist_message(conversation_id, message, attachment_id, client_id)
+                except DuplicateMessage as duplicate:
+                    window.add(key, duplicate.message)
+                    await self.send_ack(conversation_id, client_id, duplicate.message, duplicate=True)
+                    return message_type, 'duplicate'
+
+                if client_id is not None:
+                    window.add(key, saved_message)
+                    await self.send_ack(conversation_id, client_id, saved_message)
+
                 if saved_message:
+                    # The message itself ends the sender's typing state
+                    get_typing_tracker(self.channel_layer).clear(conversation_id, self.user.id)
+
                     # Send message to conversation group
-                    await self.channel_layer.group_send(
-                        self.conversation_group_name,
-                        {
+                    await send_to_conversation(
+                        self.channel_layer,
+                        conversation_id,
+                        fanout_shards(self.is_group(conversation_id)),
+                        frame_event('chat_message', {
                             'type': 'chat_message',
+                            'conversation_id': conversation_id,
                             'message': saved_message
-                        }
+                        })
                     )
             elif message_type == 'typing':
-                username = text_data_json['username']
-                is_typing = text_data_json['is_typing']
-                
-                # Broadcast typing status to group
-                await self.channel_layer.group_send(
-                    self.conversation_group_name,
-                    {
-                        'type': 'typing_status',
-                        'username': username,
-                        'is_typing': is_typing
-                    }
+                is_typing = bool(text_data_json['is_typing'])
+
+                # Only state transitions reach the group, rate limited per user
+                await get_typing_tracker(self.channel_layer).update(
+                    conversation_id, self.user.id, self.user.username, is_typing,
+                    fanout_shards(self.is_group(conversation_id))
                 )
+            elif message_type == 'mark_read':
+                message_id = int(text_data_json['message_id'])
+
+                # One watermark UPDATE, one tiny frame to the other participant.
+                # Group reads are not broadcast: each would reach every member.
+                unread_count = await self.mark_read(conversation_id, message_id)
+                if unread_count is not None:
+                    # The user's own sockets update their conversation lists
+                    await metrics.timed_group_send(
+                        self.channel_layer, user_group(self.user.id), unread_event(conversation_id, unread_count)
+                    )
+                if unread_count is not None and not self.is_group(conversation_id):
+                    await metrics.timed_group_send(
+                        self.channel_layer,
+                        conversation_group(conversation_id),
+                        frame_event('read_up_to', {
+                            'type': 'read_up_to',
+                            'conversation_id': conversation_id,
+                            'username': self.user.username,
+                            'message_id': message_id
+                        })
+                    )
+            elif message_type == 'load_history':
+                before_id = text_data_json.get('before_id')
+                messages, has_more = await self.get_history(
+                    conversation_id,
+                    before_id=int(before_id) if before_id is not None else None,
+                    limit=text_data_json.get('limit')
+                )
+                frame = {
+                    'type': 'history',
+                    'conversation_id': conversation_id,
+                    'before_id': before_id,
+                    'messages': messages,
+                    'has_more': has_more
+                }
+                if before_id is None:
+                    frame['read_up_to'] = await self.get_watermarks(conversation_id)
+                await self.send_frame(frame)
+            elif message_type == 'sync':
+                await self.send_sync(conversation_id, int(text_data_json['since']))
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': f'Error processing message: {str(e)}'
-            }))
+            })
+            return message_type, 'error'
+        return message_type, 'ok'
 
     async def chat_message(self, event):
-        message = event['message']
-        
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': message
-        }))
-
-    async def messages_read(self, event):
-        # Broadcast the read status to other users in the group
-        await self.send(text_data=json.dumps({
-            'type': 'messages_read',
-            'message_ids': event['message_ids'],
-            'sender_username': event['sender_username']
-        }))
+        await self.forward(event)
+
+    async def read_up_to(self, event):
+        # A participant has read everything up to message_id
+        await self.forward(event)
 
     async def typing_status(self, event):
         # Send typing status to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'typing_status',
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
+        await self.forward(event)
+
+    async def presence(self, event):
+        # Another participant came online or went offline
+        if event['user_id'] != self.user.id:
+            await self.forward(event)
+
+    async def send_ack(self, conversation_id, client_id, message, duplicate=False):
+        # Tells the sender its message is stored, so it can stop retrying
+        await self.send_frame({
+            'type': 'ack',
+            'conversation_id': conversation_id,
+            'client_id': client_id,
+            'message_id': message['id'],
+            'seq': message['seq'],
+            'timestamp': message['timestamp'],
+            'duplicate': duplicate
+        })
+
+    async def persist_message(self, conversation_id, message, attachment_id=None, client_id=None):
+        # Group commit trades a few milliseconds of latency for far fewer
+        # write transactions under bursty traffic.
+        if attachment_id is None and getattr(settings, 'CHAT_GROUP_COMMIT', False):
+            return await get_batcher().submit(conversation_id, self.user, message, client_id)
+        return await self.save_message(conversation_id, message, attachment_id, client_id)
+
+    @database_sync_to_async
+    def save_message(self, conversation_id, message, attachment_id=None, client_id=None):
+        """Store a message; raises ``DuplicateMessage`` if ``client_id`` was already sent"""
+        # Membership was checked in connect(), so this is a bare INSERT plus
+        # the summary and unread-counter UPDATEs.
+        with metrics.DB_OPERATION_SECONDS.time(operation='save_message'), transaction.atomic():
+            attachment = None
+            if attachment_id is not None:
+                # Only the sender's own finished uploads into this conversation
+                attachment = Attachment.objects.filter(
+                    id=attachment_id, owner=self.user, conversation_id=conversation_id, media__isnull=False
+                ).first()
+                if attachment is None:
+                    raise ValueError('Unknown attachment')
+            try:
+                # A savepoint, so a duplicate also gives back its seq
+                with transaction.atomic():
+                    message_obj = Message.objects.create(
+                        conversation_id=conversation_id,
+                        sender=self.user,
+                        content=message,
+                        attachment=attachment,
+                        client_id=client_id
+                    )
+            except IntegrityError:
+                existing = None
+                if client_id is not None:
+                    existing = Message.objects.select_related('sender', 'attachment').filter(
+                        conversation_id=conversation_id, sender=self.user, client_id=client_id
+                    ).first()
+                if existing is None:
+                    raise
+                raise DuplicateMessage(existing.to_dict())
+
+            # Update conversation timestamp, summary and read states
+            Conversation.record_messages(conversation_id, [message_obj], timezone.now())
+
+            # Indexing for search does not hold up the send
+            tasks.enqueue(index_message_ids, [message_obj.id])
+
+        return message_obj.to_dict()
+
+    @database_sync_to_async
+    def mark_read(self, conversation_id, message_id):
+        """The user's new unread count if the watermark moved, else ``None``"""
+        with metrics.DB_OPERATION_SECONDS.time(operation='mark_read'):
+            if ReadState.mark_read(conversation_id, self.user.id, message_id):
+                return ReadState.unread_for(conversation_id, self.user.id)
+            return None
+
+    @database_sync_to_async
+    def get_watermarks(self, conversation_id):
+        return ReadState.watermarks(conversation_id)
+
+    @database_sync_to_async
+    def get_delta(self, conversation_id, since, last_seq=None):
+        with metrics.DB_OPERATION_SECONDS.time(operation='get_delta'):
+            messages = fetch_since(conversation_id, since, last_seq)
+            # Watermarks only matter to a client that has new messages to tick
+            read_up_to = ReadState.watermarks(conversation_id) if messages else None
+            return messages, read_up_to
 
     @database_sync_to_async
-    def save_message(self, username, message):
+    def get_history(self, conversation_id, before_id=None, limit=None):
+        with metrics.DB_OPERATION_SECONDS.time(operation='get_history'):
+            return fetch_history(conversation_id, before_id=before_id, limit=limit)
+
+
+class ChatConsumer(BaseChatConsumer):
+    """Socket bound to a single conversation (``ws/chat/<id>/``).
+
+    A client reconnecting with ``?since=<seq>`` only receives the messages it
+    missed instead of the whole recent history.
+    """
+    metrics_label = 'chat'
+    group_chat = False
+
+    async def connect(self):
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
+        self.conversation_group_name = conversation_group(self.conversation_id)
+        self.is_member = False
+
+        # Authorize once per socket; the result is cached for its lifetime
+        # and revoked through a membership_changed event.
+        membership = await self.check_membership() if self.authenticate() else None
+        if membership is None:
+            await self.close()
+            return
+        last_seq, self.group_chat = membership
+        self.is_member = True
+        # Group conversations spread their sockets over shard groups
+        self.conversation_group_name = socket_group(
+            self.conversation_id, fanout_shards(self.group_chat), self.channel_name
+        )
+
+        # Join conversation group
+        await self.channel_layer.group_add(
+            self.conversation_group_name,
+            self.channel_name
+        )
+
+        await self.accept_negotiated()
+        await self.join_presence()
+
+        since = self.get_since()
+        if since is not None:
+            # Reconnect: the delta is read after joining the group, so
+            # nothing sent in between can be missed
+            await self.send_sync(self.conversation_id, since, last_seq)
+            return
+
+        # Send recent messages when user connects
+        messages, has_more = await self.get_recent_messages()
+        await self.send_frame({
+            'type': 'recent_messages',
+            'conversation_id': self.conversation_id,
+            'messages': messages,
+            'has_more': has_more,
+            'read_up_to': await self.get_watermarks(self.conversation_id)
+        })
+
+    async def disconnect(self, close_code):
+        if self.is_member:
+            await get_typing_tracker(self.channel_layer).stop([self.conversation_id], self.user.id)
+        await self.leave_presence()
+
+        # Leave conversation group
+        await self.channel_layer.group_discard(
+            self.conversation_group_name,
+            self.channel_name
+        )
+
+    def resolve_conversation(self, data):
+        return self.conversation_id if self.is_member else None
+
+    def is_group(self, conversation_id):
+        return self.group_chat
+
+    def get_since(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            user = User.objects.get(username=username)
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            
-            # Check if user is a participant in the conversation
-            if not conversation.participants.filter(id=user.id).exists():
-                return None
-            
-            message_obj = Message.objects.create(
-                conversation=conversation,
-                sender=user,
-                content=message
-            )
-            
-            # Update conversation timestamp
-            conversation.save()
-            
-            return message_obj.to_dict()
-        except (User.DoesNotExist, Conversation.DoesNotExist):
+            return int(query['since'][0])
+        except (KeyError, ValueError):
             return None
 
+    async def membership_changed(self, event):
+        # Drop the cached authorization if this user was removed
+        removed = event['removed_user_ids']
+        if removed is None or self.user.id in removed:
+            self.is_member = False
+            await self.leave_presence()
+            await self.close()
+        elif 'frame' in event:
+            # Group members see who joined or left
+            await self.forward(event)
+
+    @database_sync_to_async
+    def check_membership(self):
+        """``(last_seq, is_group)`` if the user takes part in the conversation, else ``None``"""
+        with metrics.DB_OPERATION_SECONDS.time(operation='check_membership'):
+            return Conversation.objects.filter(
+                id=self.conversation_id,
+                participants__id=self.user.id
+            ).values_list('last_seq', 'is_group').first()
+
     @database_sync_to_async
     def get_recent_messages(self):
+        with metrics.DB_OPERATION_SECONDS.time(operation='get_recent_messages'):
+            return fetch_history(self.conversation_id)
+
+
+class UserConsumer(BaseChatConsumer):
+    """One multiplexed socket per user (``ws/user/``).
+
+    The socket subscribes to the groups of all the user's conversations and
+    tags every frame with ``conversation_id``, so switching chats on the
+    client needs no new handshake.
+    """
+    metrics_label = 'user'
+
+    async def connect(self):
+        if not self.authenticate():
+            await self.close()
+            return
+        self.user_group_name = user_group(self.user.id)
+        # Conversation id -> whether it is a group conversation
+        self.conversation_ids = await self.get_conversation_ids()
+        metrics.WS_SUBSCRIPTIONS.observe(len(self.conversation_ids))
+
+        # The user group delivers conversations the user joins later on
+        await asyncio.gather(
+            self.channel_layer.group_add(self.user_group_name, self.channel_name),
+            *[
+                self.channel_layer.group_add(self.subscription_group(conversation_id), self.channel_name)
+                for conversation_id in self.conversation_ids
+            ]
+        )
+
+        await self.accept_negotiated()
+        await self.join_presence()
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'user_group_name'):
+            return
+        await get_typing_tracker(self.channel_layer).stop(self.conversation_ids, self.user.id)
+        await self.leave_presence()
+        await asyncio.gather(
+            self.channel_layer.group_discard(self.user_group_name, self.channel_name),
+            *[
+                self.channel_layer.group_discard(self.subscription_group(conversation_id), self.channel_name)
+                for conversation_id in self.conversation_ids
+            ]
+        )
+
+    def resolve_conversation(self, data):
         try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            messages = conversation.messages.order_by('-timestamp')[:50]
-            return [msg.to_dict() for msg in reversed(messages)]
-        except Conversation.DoesNotExist:
-            return []
+            conversation_id = int(data.get('conversation_id'))
+        except (TypeError, ValueError):
+            return None
+        return conversation_id if conversation_id in self.conversation_ids else None
+
+    def is_group(self, conversation_id):
+        return self.conversation_ids[conversation_id]
+
+    def subscription_group(self, conversation_id):
+        return socket_group(conversation_id, fanout_shards(self.is_group(conversation_id)), self.channel_name)
+
+    async def conversation_joined(self, event):
+        conversation_id = event['conversation_id']
+        if conversation_id in self.conversation_ids:
+            return
+        summary = await self.get_conversation_summary(conversation_id)
+        if summary is None:
+            # Deleted again before this socket caught up
+            return
+        self.conversation_ids[conversation_id] = event['is_group']
+        await self.channel_layer.group_add(self.subscription_group(conversation_id), self.channel_name)
+        # The list entry itself, so the client need not refetch its whole list
+        await self.send_frame({
+            'type': 'conversation_joined',
+            'conversation_id': conversation_id,
+            'conversation': summary,
+        })
+
+    async def conversation_updated(self, event):
+        await self.forward(event)
+
+    async def membership_changed(self, event):
+        # Unsubscribe from conversations this user was removed from
+        conversation_id = event['conversation_id']
+        removed = event['removed_user_ids']
+        if conversation_id not in self.conversation_ids:
+            return
+        if removed is None or self.user.id in removed:
+            group = self.subscription_group(conversation_id)
+            del self.conversation_ids[conversation_id]
+            await self.channel_layer.group_discard(group, self.channel_name)
+            await self.send_frame({
+                'type': 'conversation_removed',
+                'conversation_id': conversation_id
+            })
+        elif 'frame' in event:
+            await self.forward(event)
+
+    @database_sync_to_async
+    def get_conversation_ids(self):
+        return dict(
+            Conversation.participants.through.objects.filter(user_id=self.user.id)
+            .values_list('conversation_id', 'conversation__is_group')
+        )
+
+    @database_sync_to_async
+    def get_conversation_summary(self, conversation_id):
+        conversation = (
+            Conversation.objects.filter(id=conversation_id)
+            .annotate(unread_count=ReadState.unread_count_subquery(self.user))
+            .first()
+        )
+        return conversation.to_summary_dict(self.user) if conversation else None
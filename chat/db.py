@@ -0,0 +1,65 @@
+"""``database_sync_to_async`` with an optional bounded thread pool.
+
+channels runs every ``database_sync_to_async`` call of a consumer on a single
+shared thread. That suits SQLite, which only has one writer anyway, but
+serializes all database work of the process on a server database. With
+``CHAT_DB_POOL_SIZE`` set, calls run on that many threads instead. Each
+thread keeps its own persistent connection (``CONN_MAX_AGE``), so the pool
+also caps the number of database connections per process.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+
+_executor = None
+_executor_size = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """The shared database thread pool, or ``None`` when pooling is off"""
+    global _executor, _executor_size
+    size = getattr(settings, 'CHAT_DB_POOL_SIZE', None)
+    if not size:
+        return None
+    with _lock:
+        if _executor is None or _executor_size != size:
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='chat-db')
+            _executor_size = size
+        return _executor
+
+
+def close_pool():
+    """Close every pooled thread's connections and retire the pool"""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return
+    # One blocking task per worker makes every thread run exactly one of them
+    barrier = threading.Barrier(executor._max_workers)
+
+    def close():
+        connections.close_all()
+        barrier.wait(timeout=10)
+
+    for future in [executor.submit(close) for _ in range(executor._max_workers)]:
+        future.result()
+    executor.shutdown()
+
+
+def database_sync_to_async(func):
+    thread_sensitive = DatabaseSyncToAsync(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor = get_executor()
+        if executor is None:
+            return await thread_sensitive(*args, **kwargs)
+        return await DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)(*args, **kwargs)
+
+    return wrapper
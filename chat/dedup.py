@@ -0,0 +1,85 @@
+"""Idempotent sends keyed by client-generated message ids.
+
+A client may tag a ``chat_message`` frame with a ``client_id`` and resend it,
+unchanged, until the server acknowledges it. ``(conversation, sender,
+client_id)`` is unique on ``Message``, so a retry can never be written twice.
+Most retries come back within seconds to the same process, and a
+``SendWindow`` of recent sends answers those without touching the database.
+"""
+import asyncio
+import time
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import CLIENT_ID_MAX_LENGTH
+
+
+class DuplicateMessage(Exception):
+    """The sender already sent this ``client_id``; ``message`` is the stored copy"""
+
+    def __init__(self, message):
+        super().__init__('Duplicate client_id')
+        self.message = message
+
+
+def clean_client_id(value):
+    """A frame's ``client_id``, or ``None`` when it has none"""
+    if value is None:
+        return None
+    if not isinstance(value, str) or not 0 < len(value) <= CLIENT_ID_MAX_LENGTH:
+        raise ValueError('Invalid client_id')
+    return value
+
+
+class SendWindow:
+    """Recently saved messages by ``(conversation_id, sender_id, client_id)``.
+
+    Entries live for ``ttl`` seconds and at most ``max_entries`` are kept, so
+    the window stays small; anything it has forgotten is still caught by the
+    unique constraint.
+    """
+
+    def __init__(self, ttl, max_entries, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # Insertion order is expiry order, as every entry has the same ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, message = entry
+        if expires <= self.clock():
+            del self.entries[key]
+            return None
+        return message
+
+    def add(self, key, message):
+        now = self.clock()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, message)
+        while self.entries:
+            expires, _ = next(iter(self.entries.values()))
+            if expires > now and len(self.entries) <= self.max_entries:
+                break
+            self.entries.popitem(last=False)
+
+
+_windows = weakref.WeakKeyDictionary()
+
+
+def get_send_window():
+    """Return the send window bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    window = _windows.get(loop)
+    if window is None:
+        window = SendWindow(
+            ttl=getattr(settings, 'CHAT_SEND_DEDUP_SECONDS', 300),
+            max_entries=getattr(settings, 'CHAT_SEND_DEDUP_MAX_ENTRIES', 10000),
+        )
+        _windows[loop] = window
+    return window
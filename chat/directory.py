@@ -0,0 +1,63 @@
+"""Username autocomplete for starting conversations.
+
+Migration 0010 indexes ``UPPER(username)`` on ``auth_user`` (in the "C"
+collation on PostgreSQL, so the index is in plain code point order). A
+prefix becomes the key range ``[UPPER(prefix), UPPER(prefix) || U+10FFFF)``,
+which both databases answer with an ordered index range scan that stops
+after one page, however many accounts exist. Pages are cached for
+``CHAT_USER_SEARCH_CACHE_SECONDS``, so hot prefixes skip the database.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Value
+from django.db.models.functions import Collate, Concat, Upper
+
+INDEX_NAME = 'chat_user_username_key_idx'
+
+# Sorts after every other character, closing the prefix range
+MAX_CHAR = '\U0010ffff'
+
+
+def get_page_size(limit):
+    default = getattr(settings, 'CHAT_USER_SEARCH_PAGE_SIZE', 20)
+    maximum = getattr(settings, 'CHAT_USER_SEARCH_MAX_PAGE_SIZE', 50)
+    try:
+        limit = int(limit) if limit is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def username_key():
+    """The indexed expression; must match the migration exactly"""
+    key = Upper('username')
+    if connection.vendor == 'postgresql':
+        key = Collate(key, 'C')
+    return key
+
+
+def search_users(prefix, offset=0, limit=None):
+    """Active users whose username starts with ``prefix``, ignoring case.
+
+    Returns ``(users, has_more)`` with users as ``{'id', 'username'}`` dicts.
+    """
+    limit = get_page_size(limit)
+    offset = max(offset, 0)
+    digest = hashlib.sha1(f'{prefix}\0{offset}\0{limit}'.encode()).hexdigest()
+    cache_key = f'chat:users:{digest}'
+    page = cache.get(cache_key)
+    if page is None:
+        start = Upper(Value(prefix))
+        users = list(
+            User.objects.annotate(username_key=username_key())
+            .filter(username_key__gte=start, username_key__lt=Concat(start, Value(MAX_CHAR)), is_active=True)
+            .order_by('username_key', 'id')
+            .values('id', 'username')[offset:offset + limit + 1]
+        )
+        page = (users[:limit], len(users) > limit)
+        cache.set(cache_key, page, getattr(settings, 'CHAT_USER_SEARCH_CACHE_SECONDS', 60))
+    return page
@@ -0,0 +1,46 @@
+"""Delivery of conversation-wide events to every connected member.
+
+A direct conversation is one channel-layer group. A group conversation's
+sockets are spread over ``CHAT_GROUP_FANOUT_SHARDS`` sub-groups, so a message
+becomes one ``group_send`` per shard: each touches only a slice of the
+members, and the shards are sent concurrently.
+
+With ``CHAT_FANOUT_CHANNEL`` set, the sender only hands each shard to that
+channel and ``manage.py runworker <channel>`` processes do the group sends,
+so a busy group never holds up the sending socket. Any number of workers
+can share the channel.
+"""
+import asyncio
+
+from channels.consumer import AsyncConsumer
+from django.conf import settings
+
+from .groups import conversation_groups
+from .metrics import timed_group_send
+
+
+async def fan_out(channel_layer, groups, event):
+    """Send ``event`` to every group in ``groups``"""
+    groups = list(groups)
+    if len(groups) == 1:
+        await timed_group_send(channel_layer, groups[0], event)
+        return
+    channel = getattr(settings, 'CHAT_FANOUT_CHANNEL', None)
+    if channel:
+        await asyncio.gather(*[
+            channel_layer.send(channel, {'type': 'fanout.group_send', 'group': group, 'event': event})
+            for group in groups
+        ])
+    else:
+        await asyncio.gather(*[timed_group_send(channel_layer, group, event) for group in groups])
+
+
+async def send_to_conversation(channel_layer, conversation_id, shards, event):
+    await fan_out(channel_layer, conversation_groups(conversation_id, shards), event)
+
+
+class FanoutConsumer(AsyncConsumer):
+    """Worker performing the shard group sends handed to ``CHAT_FANOUT_CHANNEL``"""
+
+    async def fanout_group_send(self, message):
+        await timed_group_send(self.channel_layer, message['group'], message['event'])
@@ -0,0 +1,42 @@
+import zlib
+
+from django.conf import settings
+
+
+def conversation_group(conversation_id, shard=None):
+    """Channel-layer group every socket showing a conversation belongs to.
+
+    Group conversations spread their sockets over ``fanout_shards()``
+    sub-groups instead; ``shard`` names one of them.
+    """
+    if shard is None:
+        return f'chat_{conversation_id}'
+    return f'chat_{conversation_id}.{shard}'
+
+
+def fanout_shards(is_group):
+    """Number of sub-groups a conversation's sockets are spread over.
+
+    Must not change while sockets are connected: senders and receivers have
+    to agree on it.
+    """
+    return getattr(settings, 'CHAT_GROUP_FANOUT_SHARDS', 16) if is_group else 1
+
+
+def socket_group(conversation_id, shards, channel_name):
+    """The one group of a conversation that the socket ``channel_name`` joins"""
+    if shards == 1:
+        return conversation_group(conversation_id)
+    return conversation_group(conversation_id, zlib.crc32(channel_name.encode()) % shards)
+
+
+def conversation_groups(conversation_id, shards):
+    """Every group an event for the whole conversation has to reach"""
+    if shards == 1:
+        return [conversation_group(conversation_id)]
+    return [conversation_group(conversation_id, shard) for shard in range(shards)]
+
+
+def user_group(user_id):
+    """Channel-layer group reaching every multiplexed socket of one user"""
+    return f'user_{user_id}'
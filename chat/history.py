@@ -0,0 +1,83 @@
+from django.conf import settings
+from django.db.models import Q
+
+from .archive import find_archived_timestamp, read_archive
+from .models import Message
+
+
+def get_page_size(limit=None):
+    """Clamp a client-supplied page size to the configured bounds"""
+    default = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+    if limit is None:
+        return default
+    return max(1, min(int(limit), maximum))
+
+
+def fetch_history(conversation_id, before_id=None, limit=None):
+    """Return ``(messages, has_more)`` for the page of messages before ``before_id``.
+
+    Keyset pagination over the (conversation, timestamp, id) index: every page
+    is an index range scan that stops after ``limit + 1`` rows, so the cost
+    does not depend on how deep into the history the client has scrolled.
+    Once the hot table runs out, the page continues into the archive.
+    """
+    limit = get_page_size(limit)
+    queryset = Message.objects.filter(conversation_id=conversation_id)
+
+    if before_id is not None:
+        anchor = (
+            Message.objects.filter(id=before_id, conversation_id=conversation_id)
+            .values_list('timestamp', flat=True)
+            .first()
+        )
+        if anchor is None:
+            # An archived anchor means everything before it is archived too
+            archived_at = find_archived_timestamp(conversation_id, before_id)
+            if archived_at is None:
+                return [], False
+            return read_archive(conversation_id, before=(archived_at, before_id), limit=limit)
+        queryset = queryset.filter(timestamp__lte=anchor).filter(
+            Q(timestamp__lt=anchor) | Q(id__lt=before_id)
+        )
+
+    page = list(
+        queryset.select_related('sender', 'attachment').order_by('-timestamp', '-id')[:limit + 1]
+    )
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+    messages = [message.to_dict() for message in page]
+    if not has_more:
+        # Archived messages are older than every hot one
+        archived, has_more = read_archive(conversation_id, limit=limit - len(messages))
+        messages = archived + messages
+    return messages, has_more
+
+
+def fetch_since(conversation_id, since, last_seq=None):
+    """Messages after sequence number ``since``, or ``None`` if the client must refetch.
+
+    A reconnecting client that saw everything up to ``since`` only needs the
+    delta, which is one range scan of the (conversation, seq) index. The
+    delta is refused when it is larger than ``CHAT_SYNC_MAX_DELTA``, when it
+    does not start right after ``since`` (older messages were archived), when
+    it is empty although ``since`` is behind the conversation's ``last_seq``,
+    or when ``since`` is ahead of it.
+    """
+    max_delta = getattr(settings, 'CHAT_SYNC_MAX_DELTA', 200)
+    if since < 0 or (last_seq is not None and since > last_seq):
+        return None
+
+    delta = list(
+        Message.objects.filter(conversation_id=conversation_id, seq__gt=since)
+        .select_related('sender', 'attachment')
+        .order_by('seq')[:max_delta + 1]
+    )
+    if len(delta) > max_delta or (delta and delta[0].seq != since + 1):
+        return None
+    if not delta and last_seq is not None and since < last_seq:
+        # Everything the client missed has left the hot table
+        return None
+    return [message.to_dict() for message in delta]
+
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Move messages older than the archive age into compressed per-conversation segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 90),
+            help='Archive messages older than this many days (default: CHAT_ARCHIVE_AFTER_DAYS)',
+        )
+        parser.add_argument(
+            '--segment-size', type=int, default=getattr(settings, 'CHAT_ARCHIVE_SEGMENT_SIZE', 500),
+            help='Messages per archive segment (default: CHAT_ARCHIVE_SEGMENT_SIZE)',
+        )
+
+    def handle(self, *args, **options):
+        total = archive_messages(timedelta(days=options['days']), options['segment_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {total} messages'))
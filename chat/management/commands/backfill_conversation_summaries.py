@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat import pagecache
+from chat.models import Conversation
+
+
+SUMMARY_FIELDS = [
+    'last_message',
+    'last_message_preview',
+    'last_message_at',
+    'last_message_sender',
+    'participant_summary',
+]
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized last-message and participant summary of every conversation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of conversations updated per transaction (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Conversation.objects.order_by('id').prefetch_related('participants')
+        total = 0
+        last_id = 0
+
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            for conversation in batch:
+                conversation.refresh_summary(save=False)
+            with transaction.atomic():
+                Conversation.objects.bulk_update(batch, SUMMARY_FIELDS)
+                pagecache.bump_conversations([conversation.id for conversation in batch], rooms=True)
+            total += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f'Backfilled {total} conversations...')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {total} conversations'))
@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat import benchmarks
+from chat.db import close_pool
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the WebSocket chat pipeline against a throwaway test database '
+        'and print the results as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=sorted(benchmarks.SCENARIOS), default='messaging')
+        parser.add_argument('--conversations', type=int, default=10)
+        parser.add_argument('--group-size', type=int, default=2, help='Members (and clients) per conversation')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by each client')
+        parser.add_argument('--members', type=int, default=5000, help='Group size for the large_group scenario')
+        parser.add_argument(
+            '--listeners', type=int, help='Connected members for the large_group scenario (default: all)'
+        )
+        parser.add_argument('--senders', type=int, default=5, help='Sending members for the large_group scenario')
+        parser.add_argument(
+            '--shards', type=int, help='Fan-out shards per group conversation (CHAT_GROUP_FANOUT_SHARDS)'
+        )
+        parser.add_argument(
+            '--transport', choices=['router', 'asgi'], default='router',
+            help='"router" drives the consumers directly; "asgi" goes through the full '
+                 'application including session authentication'
+        )
+        parser.add_argument('--group-commit', action='store_true', help='Enable CHAT_GROUP_COMMIT')
+        parser.add_argument(
+            '--db-profile', choices=['configured', 'baseline'], default='configured',
+            help='"configured" uses DATABASES as set up; "baseline" drops persistent connections '
+                 'and the SQLite pragmas, for comparison'
+        )
+        parser.add_argument(
+            '--db-threads', type=int,
+            help='Run consumer database calls on a pool of this many threads (CHAT_DB_POOL_SIZE)'
+        )
+        parser.add_argument(
+            '--db-file',
+            help='Put the SQLite test database in this file instead of memory, so journaling '
+                 'and connection setup costs are real'
+        )
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for any single frame')
+        parser.add_argument(
+            '--output', help='Append the results as one JSON line to this file, for tracking across commits'
+        )
+
+    def handle(self, *args, **options):
+        scenario = options.pop('scenario')
+        output = options.pop('output')
+        group_commit = options.pop('group_commit')
+        db_threads = options.pop('db_threads')
+        shards = options.pop('shards')
+        params = {
+            'messages': options['messages'],
+            'transport': options['transport'],
+            'timeout': options['timeout'],
+        }
+        if scenario == 'large_group':
+            params.update(members=options['members'], listeners=options['listeners'], senders=options['senders'])
+        else:
+            params.update(conversations=options['conversations'], group_size=options['group_size'])
+
+        overrides = {
+            # Large channel capacity so the layer never silently drops frames
+            'CHANNEL_LAYERS': {
+                'default': {
+                    'BACKEND': 'chat.benchmarks.BenchmarkChannelLayer',
+                    'CONFIG': {'capacity': 100000},
+                },
+            },
+            # Simulated clients send as fast as the server echoes them
+            'CHAT_INBOUND_RATE': 10 ** 6,
+            'CHAT_INBOUND_BURST': 10 ** 6,
+        }
+        if group_commit:
+            overrides['CHAT_GROUP_COMMIT'] = True
+        if db_threads is not None:
+            overrides['CHAT_DB_POOL_SIZE'] = db_threads
+        if shards is not None:
+            overrides['CHAT_GROUP_FANOUT_SHARDS'] = shards
+
+        # Shared by every thread's connection to the default database
+        settings_dict = connection.settings_dict
+        if options['db_profile'] == 'baseline':
+            settings_dict['CONN_MAX_AGE'] = 0
+            settings_dict['OPTIONS'] = {
+                key: value for key, value in settings_dict['OPTIONS'].items()
+                if key not in ('init_command', 'transaction_mode')
+            }
+        if options['db_file']:
+            settings_dict['TEST'] = {**settings_dict.get('TEST', {}), 'NAME': options['db_file']}
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**overrides):
+                try:
+                    results = benchmarks.run(scenario, **params)
+                except (RuntimeError, asyncio.TimeoutError) as e:
+                    raise CommandError(f'Benchmark failed: {e or "timed out waiting for a frame"}')
+                finally:
+                    close_pool()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        results['database']['profile'] = options['db_profile']
+
+        line = json.dumps(results)
+        if output:
+            with open(output, 'a') as f:
+                f.write(line + '\n')
+        self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from chat.transfer import CHUNK_SIZE, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Stream conversations with their full history (archive included) as JSONL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--conversation', type=int, action='append', dest='conversations',
+            help='Only export this conversation id (repeatable; default: all conversations)',
+        )
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+        parser.add_argument(
+            '--chunk-size', type=int, default=CHUNK_SIZE,
+            help='Rows fetched per database round trip',
+        )
+
+    def handle(self, *args, **options):
+        lines = export_lines(options['conversations'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.writelines(lines)
+        else:
+            self.stdout.ending = ''
+            for line in lines:
+                self.stdout.write(line)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.transfer import CHUNK_SIZE, import_stream
+
+
+class Command(BaseCommand):
+    help = 'Bulk-load a JSONL export written by export_conversations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Export file to import')
+        parser.add_argument(
+            '--batch-size', type=int, default=CHUNK_SIZE,
+            help='Rows per bulk insert and transaction',
+        )
+
+    def handle(self, *args, **options):
+        with open(options['path'], encoding='utf-8') as lines:
+            try:
+                counts = import_stream(lines, options['batch_size'])
+            except (ValueError, KeyError) as e:
+                raise CommandError(f'Invalid export: {e}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['messages']} messages in {counts['conversations']} conversations "
+            f"({counts['users']} new users)"
+        ))
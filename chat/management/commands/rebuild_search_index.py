@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text message search index from the message table'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        with transaction.atomic():
+            total = backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {type(backend).__name__} index over {total} messages'
+        ))
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.tasks import drain_due
+
+
+class Command(BaseCommand):
+    help = 'Run stored background tasks (CHAT_TASKS_DURABLE) as they fall due'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Run the tasks that are due now, then exit',
+        )
+        parser.add_argument(
+            '--poll', type=float, default=getattr(settings, 'CHAT_TASK_POLL_SECONDS', 1.0),
+            help='Seconds to wait when no task is due (default: CHAT_TASK_POLL_SECONDS)',
+        )
+
+    def handle(self, *args, **options):
+        if options['once']:
+            total = drain_due()
+            self.stdout.write(self.style.SUCCESS(f'Ran {total} tasks'))
+            return
+        try:
+            while True:
+                close_old_connections()
+                if not drain_due(limit=100):
+                    time.sleep(options['poll'])
+        except KeyboardInterrupt:
+            pass
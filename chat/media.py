@@ -0,0 +1,248 @@
+"""Attachment storage: chunked uploads, deduplicated files and ranged downloads.
+
+An upload is written to ``attachments/incoming/<id>.part`` under
+``MEDIA_ROOT`` in bounded reads, never held in memory. Each chunk states the
+offset it starts at, so an interrupted upload resumes from the last byte the
+server has. Once complete the file is hashed and moved to a path named after
+its SHA-256, or dropped if those bytes are already stored. Dimensions and
+thumbnails (with Pillow installed) are computed by a background task
+(``chat.tasks``), off the request and consumer paths.
+
+Downloads honour single ``Range`` requests. With ``CHAT_MEDIA_ACCEL_REDIRECT``
+set, the response only names the file and the front server (nginx) sends it
+with ``sendfile``. Otherwise the file is read in ``BLOCK_SIZE`` blocks: under
+ASGI through an async iterator (``chat.streaming``), as Django would buffer a
+synchronous one whole, and under WSGI whole files go through
+``FileResponse`` and the server's ``wsgi.file_wrapper``.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from . import tasks
+from .models import Attachment, MediaFile
+from .streaming import is_asgi, response_body
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - thumbnails are optional
+    Image = None
+
+BLOCK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Served inline; anything else is a download, so uploaded HTML or SVG never
+# runs on the site's origin
+INLINE_TYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'audio/mpeg', 'audio/ogg', 'video/mp4', 'video/webm',
+}
+
+
+class OffsetMismatch(Exception):
+    """A chunk did not start where the upload currently ends"""
+
+    def __init__(self, offset):
+        super().__init__(f'Upload is at offset {offset}')
+        self.offset = offset
+
+
+def media_path(name):
+    return os.path.join(settings.MEDIA_ROOT, name)
+
+
+def part_path(attachment):
+    return media_path(os.path.join('attachments', 'incoming', f'{attachment.id}.part'))
+
+
+def append_chunk(attachment, offset, stream, length):
+    """Write ``length`` bytes from ``stream`` at ``offset``; returns the new offset.
+
+    Bytes beyond the declared size are refused. A short read (the client
+    went away) keeps what arrived, and the client resumes from there. The
+    chunk is first received into its own file, and only spliced into the
+    upload once this request has claimed ``offset``, so a concurrent chunk
+    for the same offset can never overwrite the winner's bytes.
+    """
+    if offset != attachment.received:
+        raise OffsetMismatch(attachment.received)
+    if length < 0 or offset + length > attachment.size:
+        raise ValueError('Chunk runs past the declared size')
+
+    path = part_path(attachment)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, chunk_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'{attachment.id}.', suffix='.chunk')
+    try:
+        written = 0
+        with open(fd, 'w+b') as chunk:
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                chunk.write(block)
+                written += len(block)
+
+            # Only one writer can move the offset; a concurrent chunk loses.
+            # The splice runs in the same transaction, so the next offset is
+            # not claimable before these bytes are in place.
+            with transaction.atomic():
+                if not Attachment.objects.filter(id=attachment.id, received=offset).update(received=offset + written):
+                    attachment.refresh_from_db(fields=['received'])
+                    raise OffsetMismatch(attachment.received)
+                chunk.seek(0)
+                with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                    f.seek(offset)
+                    for block in iter(lambda: chunk.read(BLOCK_SIZE), b''):
+                        f.write(block)
+                    f.truncate()
+    finally:
+        os.remove(chunk_path)
+
+    attachment.received = offset + written
+    if attachment.received == attachment.size:
+        complete(attachment)
+    return attachment.received
+
+
+def complete(attachment):
+    """Hash the finished upload and link it to the stored copy of its bytes"""
+    path = part_path(attachment)
+    if not os.path.exists(path):
+        # An empty file never had a chunk written
+        open(path, 'wb').close()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    sha256 = digest.hexdigest()
+
+    media = MediaFile.objects.filter(sha256=sha256).first()
+    if media is None:
+        name = os.path.join('attachments', sha256[:2], sha256)
+        os.makedirs(os.path.dirname(media_path(name)), exist_ok=True)
+        # Identical bytes, so replacing a racing upload's file is harmless
+        os.replace(path, media_path(name))
+        try:
+            with transaction.atomic():
+                media = MediaFile.objects.create(
+                    sha256=sha256, size=attachment.size, file=name, content_type=attachment.content_type
+                )
+        except IntegrityError:
+            media = MediaFile.objects.get(sha256=sha256)
+        else:
+            tasks.enqueue(process_media, media.id)
+    else:
+        os.remove(path)
+
+    attachment.media = media
+    attachment.save(update_fields=['media'])
+
+
+def process_media(media_id):
+    """Background task: record an image's dimensions and write its thumbnail"""
+    media = MediaFile.objects.filter(id=media_id).first()
+    if media is None or media.processed_at is not None:
+        return
+    values = {'processed_at': timezone.now()}
+    if Image is not None:
+        values.update(make_thumbnail(media))
+    MediaFile.objects.filter(id=media_id).update(**values)
+
+
+def make_thumbnail(media):
+    size = getattr(settings, 'CHAT_THUMBNAIL_SIZE', 320)
+    try:
+        with Image.open(media_path(media.file.name)) as image:
+            values = {
+                'width': image.width,
+                'height': image.height,
+                'content_type': Image.MIME.get(image.format, media.content_type),
+            }
+            image.thumbnail((size, size))
+            name = os.path.join('attachments', 'thumbnails', media.sha256[:2], f'{media.sha256}.jpg')
+            os.makedirs(os.path.dirname(media_path(name)), exist_ok=True)
+            image.convert('RGB').save(media_path(name), 'JPEG', quality=80)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # Not an image Pillow can read
+        return {}
+    values['thumbnail'] = name
+    return values
+
+
+def parse_range(header, size):
+    """``(start, end)`` inclusive for a single byte range, ``None`` for the whole file.
+
+    Raises ``ValueError`` when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None or size == 0:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the final N bytes
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def serve_file(request, name, size, content_type, filename):
+    """Response for a stored file, honouring ``Range``"""
+    inline = content_type in INLINE_TYPES
+    try:
+        byte_range = parse_range(request.headers.get('Range'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    accel = getattr(settings, 'CHAT_MEDIA_ACCEL_REDIRECT', None)
+    if accel:
+        # The front server reads the file and handles Range itself
+        response = HttpResponse(content_type=content_type if inline else 'application/octet-stream')
+        response['X-Accel-Redirect'] = accel.rstrip('/') + '/' + name
+    elif byte_range is None and not is_asgi(request):
+        response = FileResponse(
+            open(media_path(name), 'rb'),
+            content_type=content_type if inline else 'application/octet-stream',
+        )
+    else:
+        start, end = byte_range or (0, size - 1)
+        response = StreamingHttpResponse(
+            # File reads need no database connection, so any thread will do
+            response_body(request, read_range(media_path(name), start, end), thread_sensitive=False),
+            status=200 if byte_range is None else 206,
+            content_type=content_type if inline else 'application/octet-stream',
+        )
+        response['Content-Length'] = end - start + 1
+        if byte_range is not None:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(not inline, filename)
+    response['X-Content-Type-Options'] = 'nosniff'
+    # Content-addressed, so a given URL's bytes never change
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
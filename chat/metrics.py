@@ -0,0 +1,321 @@
+"""In-process counters and latency histograms for the chat hot paths.
+
+Samples are aggregated in memory under a single lock (no per-sample
+allocation) and rendered in the Prometheus text format by the ``/metrics``
+view, which requires ``CHAT_METRICS_TOKEN`` as a bearer token (or a staff
+login). Every worker process keeps its own registry, so scrape each worker
+separately. Set ``CHAT_METRICS_ENABLED = False`` to turn all of it into
+no-ops.
+"""
+import contextvars
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Seconds; tuned for sub-millisecond queries up to slow multi-second requests
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000, 5000)
+
+_lock = threading.Lock()
+
+
+def metrics_enabled():
+    return getattr(settings, 'CHAT_METRICS_ENABLED', True)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def clear(self):
+        with _lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with _lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+            for key, value in items
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not metrics_enabled():
+            return
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not metrics_enabled():
+            return
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (plus +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REGISTRY = []
+
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+WS_CONNECTS = _register(Counter(
+    'chat_ws_connects_total', 'WebSocket handshakes by consumer and outcome', ['consumer', 'outcome']
+))
+WS_CONNECT_SECONDS = _register(Histogram(
+    'chat_ws_connect_seconds', 'Time spent in consumer connect()', ['consumer']
+))
+WS_ACTIVE = _register(Gauge(
+    'chat_ws_active_sockets', 'Currently open WebSocket connections', ['consumer']
+))
+WS_FRAMES = _register(Counter(
+    'chat_ws_frames_total', 'Inbound WebSocket frames by type and outcome', ['type', 'outcome']
+))
+WS_FRAME_SECONDS = _register(Histogram(
+    'chat_ws_frame_seconds', 'Time spent handling one inbound frame', ['type']
+))
+WS_DELIVERY_LAG = _register(Histogram(
+    'chat_ws_delivery_lag_seconds', 'Age of fan-out events when a socket forwards them', ['event']
+))
+WS_QUEUE_DEPTH = _register(Histogram(
+    'chat_ws_queue_depth', 'Events queued for a socket when it forwards one', buckets=COUNT_BUCKETS
+))
+WS_SHED_EVENTS = _register(Counter(
+    'chat_ws_shed_events_total', 'Low-priority events dropped for lagging sockets', ['event']
+))
+WS_SLOW_DISCONNECTS = _register(Counter(
+    'chat_ws_slow_disconnects_total', 'Sockets closed for staying behind their event stream', ['consumer']
+))
+WS_SUBSCRIPTIONS = _register(Histogram(
+    'chat_ws_subscriptions', 'Conversation groups joined per multiplexed socket', buckets=COUNT_BUCKETS
+))
+DB_OPERATION_SECONDS = _register(Histogram(
+    'chat_db_operation_seconds', 'Time spent in consumer database operations', ['operation']
+))
+DB_QUERIES = _register(Counter(
+    'chat_db_queries_total', 'ORM queries executed', ['alias']
+))
+DB_QUERY_SECONDS = _register(Histogram(
+    'chat_db_query_seconds', 'ORM query execution time', ['alias']
+))
+QUERIES_PER_UNIT = _register(Histogram(
+    'chat_db_queries_per_unit', 'ORM queries per HTTP request or WebSocket frame', ['unit'],
+    buckets=COUNT_BUCKETS
+))
+QUERY_SECONDS_PER_UNIT = _register(Histogram(
+    'chat_db_query_seconds_per_unit', 'Total ORM time per HTTP request or WebSocket frame', ['unit']
+))
+GROUP_SENDS = _register(Counter(
+    'chat_group_sends_total', 'Channel-layer group_send calls by event', ['event']
+))
+GROUP_SEND_SECONDS = _register(Histogram(
+    'chat_group_send_seconds', 'Channel-layer group_send latency by event', ['event']
+))
+GROUP_SIZE = _register(Histogram(
+    'chat_group_size', 'Participants reached per message write', buckets=COUNT_BUCKETS
+))
+TASK_RUNS = _register(Counter(
+    'chat_tasks_total', 'Background task runs by task and outcome', ['task', 'outcome']
+))
+TASK_SECONDS = _register(Histogram(
+    'chat_task_seconds', 'Background task run time by task', ['task']
+))
+TASK_QUEUE_WAIT = _register(Histogram(
+    'chat_task_queue_wait_seconds', 'Time from commit to the start of a background task', ['task']
+))
+HTTP_REQUESTS = _register(Counter(
+    'chat_http_requests_total', 'HTTP requests by view, method and status', ['view', 'method', 'status']
+))
+HTTP_REQUEST_SECONDS = _register(Histogram(
+    'chat_http_request_seconds', 'HTTP request latency by view', ['view']
+))
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Query statistics of the HTTP request or WebSocket frame being handled.
+# database_sync_to_async copies the context into its worker thread, so
+# queries run there are attributed to the frame that triggered them.
+_query_stats = contextvars.ContextVar('chat_query_stats', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper feeding the query counters"""
+    if not metrics_enabled():
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        alias = context['connection'].alias
+        DB_QUERIES.inc(alias=alias)
+        DB_QUERY_SECONDS.observe(elapsed, alias=alias)
+        stats = _query_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """connection_created receiver attaching ``record_query`` to new connections"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def track_queries(unit):
+    """Count the ORM queries run while handling one request or frame"""
+    if not metrics_enabled():
+        yield
+        return
+    stats = [0, 0.0]
+    token = _query_stats.set(stats)
+    try:
+        yield
+    finally:
+        _query_stats.reset(token)
+        QUERIES_PER_UNIT.observe(stats[0], unit=unit)
+        QUERY_SECONDS_PER_UNIT.observe(stats[1], unit=unit)
+
+
+async def timed_group_send(channel_layer, group, event):
+    """``channel_layer.group_send`` with its latency recorded per event type"""
+    if not metrics_enabled():
+        return await channel_layer.group_send(group, event)
+    with GROUP_SEND_SECONDS.time(event=event['type']):
+        await channel_layer.group_send(group, event)
+    GROUP_SENDS.inc(event=event['type'])
+
+
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def scrape_allowed(request):
+    """Whether ``request`` may read ``/metrics``: a bearer token matching
+    ``CHAT_METRICS_TOKEN``, or a logged-in staff user"""
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+    header = request.headers.get('Authorization', '')
+    if token and header.startswith('Bearer ') and hmac.compare_digest(header[7:].encode(), token.encode()):
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
+class MetricsMiddleware:
+    """Records latency, status and query count for every HTTP request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not metrics_enabled():
+            return self.get_response(request)
+        started = time.perf_counter()
+        with track_queries('http'):
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, view=view)
+        # Clients choose the method, so only standard ones become label values
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        HTTP_REQUESTS.inc(view=view, method=method, status=response.status_code)
+        return response
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_read_states(apps, schema_editor):
+    """Derive each participant's watermark from the old per-message is_read flags"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    ReadState = apps.get_model('chat', 'ReadState')
+
+    for conversation in Conversation.objects.prefetch_related('participants').iterator(chunk_size=500):
+        states = []
+        for user in conversation.participants.all():
+            messages = Message.objects.filter(conversation=conversation)
+            read = messages.filter(models.Q(sender=user) | models.Q(is_read=True))
+            last_read = read.aggregate(last=models.Max('id'))['last'] or 0
+            unread = messages.filter(id__gt=last_read).exclude(sender=user).count()
+            states.append(ReadState(
+                conversation=conversation,
+                user=user,
+                last_read_message_id=last_read,
+                unread_count=unread,
+            ))
+        ReadState.objects.bulk_create(states, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0004_message_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='readstate',
+            constraint=models.UniqueConstraint(fields=('conversation', 'user'), name='chat_readstate_unique'),
+        ),
+        migrations.RunPython(create_read_states, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
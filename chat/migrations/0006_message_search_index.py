@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 19:40
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """Create and populate the vendor-specific full-text index"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE chat_message_fts USING fts5("
+            "content, content='chat_message', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX chat_message_content_tsv ON chat_message "
+            "USING GIN (to_tsvector('simple', content))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS chat_message_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS chat_message_content_tsv')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_read_watermarks'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
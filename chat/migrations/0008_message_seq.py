@@ -0,0 +1,53 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """Number each conversation's existing messages in history order"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+
+    for conversation_id in Conversation.objects.values_list('id', flat=True).iterator():
+        seq = 0
+        batch = []
+        messages = Message.objects.filter(conversation_id=conversation_id).order_by('timestamp', 'id')
+        for message in messages.only('id').iterator(chunk_size=1000):
+            seq += 1
+            message.seq = seq
+            batch.append(message)
+            if len(batch) == 1000:
+                Message.objects.bulk_update(batch, ['seq'])
+                batch = []
+        Message.objects.bulk_update(batch, ['seq'])
+        Conversation.objects.filter(id=conversation_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'seq'), name='chat_msg_conv_seq_uniq'),
+        ),
+    ]
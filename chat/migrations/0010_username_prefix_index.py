@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 21:05
+
+from django.db import migrations
+
+
+def create_username_index(apps, schema_editor):
+    """Index the expression chat.directory.username_key() filters and sorts on"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('CREATE INDEX chat_user_username_key_idx ON auth_user (UPPER("username"))')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX chat_user_username_key_idx ON auth_user ((UPPER("username") COLLATE "C"))'
+        )
+
+
+def drop_username_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP INDEX IF EXISTS chat_user_username_key_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('chat', '0009_user_presence'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_username_index, drop_username_index),
+    ]
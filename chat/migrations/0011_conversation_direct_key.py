@@ -0,0 +1,175 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:05
+
+import json
+import zlib
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Max
+from django.utils.dateparse import parse_datetime
+
+
+def decode_segment(data):
+    return json.loads(zlib.decompress(bytes(data)))
+
+
+def encode_segment(messages):
+    return zlib.compress(json.dumps(messages, separators=(',', ':')).encode(), 6)
+
+
+def archive_key(message):
+    return parse_datetime(message['timestamp']), message['id']
+
+
+def unindex(connection, message_ids):
+    """Drop hot rows about to be archived from the SQLite full-text index"""
+    if connection.vendor != 'sqlite' or not message_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(message_ids))
+    with connection.cursor() as cursor:
+        # Only rows that were indexed: deleting any other corrupts the index
+        cursor.execute(
+            "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) "
+            f"SELECT 'delete', id, content FROM chat_message WHERE id IN ({placeholders}) "
+            "AND id IN (SELECT id FROM chat_message_fts_docsize)",
+            message_ids,
+        )
+
+
+def merge_archives(apps, connection, keep, group, hot):
+    """Rewrite the group's archive as ``keep``'s; returns it and the messages left hot.
+
+    Archived messages must stay older than every hot one, so hot messages
+    older than the newest archived one are archived along with it.
+    """
+    Message = apps.get_model('chat', 'Message')
+    ArchiveSegment = apps.get_model('chat', 'ArchiveSegment')
+    segments = list(ArchiveSegment.objects.filter(conversation_id__in=group))
+    archived = [message for segment in segments for message in decode_segment(segment.data)]
+    if not archived:
+        return [], hot
+
+    newest = max(archive_key(message) for message in archived)
+    moving = [message for message in hot if (message.timestamp, message.id) < newest]
+    archived += [
+        {
+            'id': message.id,
+            'seq': message.seq,
+            'sender': message.sender.username,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+        }
+        for message in moving
+    ]
+    archived.sort(key=archive_key)
+    for start in range(0, len(moving), 500):
+        ids = [message.id for message in moving[start:start + 500]]
+        unindex(connection, ids)
+        Message.objects.filter(id__in=ids).delete()
+
+    ArchiveSegment.objects.filter(id__in=[segment.id for segment in segments]).delete()
+    segment_size = getattr(settings, 'CHAT_ARCHIVE_SEGMENT_SIZE', 500)
+    for seq, message in enumerate(archived, 1):
+        message['seq'] = seq
+    for start in range(0, len(archived), segment_size):
+        batch = archived[start:start + segment_size]
+        ids = [message['id'] for message in batch]
+        ArchiveSegment.objects.create(
+            conversation_id=keep,
+            first_timestamp=parse_datetime(batch[0]['timestamp']),
+            last_timestamp=parse_datetime(batch[-1]['timestamp']),
+            min_message_id=min(ids),
+            max_message_id=max(ids),
+            message_count=len(batch),
+            data=encode_segment(batch),
+        )
+    return archived, hot[len(moving):]
+
+
+def merge_conversations(apps, connection, keep, duplicates, user_ids):
+    """Fold ``duplicates`` into ``keep``, the pair's oldest conversation"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    ReadState = apps.get_model('chat', 'ReadState')
+    group = [keep, *duplicates]
+
+    # Archived messages are numbered first, as they are the oldest
+    hot = list(Message.objects.filter(conversation_id__in=group).select_related('sender').order_by('timestamp', 'id'))
+    archived, messages = merge_archives(apps, connection, keep, group, hot)
+    total = len(archived) + len(messages)
+
+    # Renumber the hot history in two passes, first above every current seq
+    # and then after the archive, so (conversation, seq) stays unique throughout
+    offset = max(Message.objects.filter(conversation_id__in=group).aggregate(Max('seq'))['seq__max'] or 0, total)
+    for seq, message in enumerate(messages, len(archived) + 1):
+        message.conversation_id = keep
+        message.seq = offset + seq
+    Message.objects.bulk_update(messages, ['conversation', 'seq'], batch_size=1000)
+    for message in messages:
+        message.seq -= offset
+    Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+
+    # Message ids are unchanged, so the newest summary of the group is still right
+    latest = Conversation.objects.filter(id__in=group).order_by(
+        F('last_message_at').desc(nulls_last=True), '-id'
+    ).first()
+    Conversation.objects.filter(id=keep).update(
+        last_seq=total,
+        last_message_id=latest.last_message_id,
+        last_message_preview=latest.last_message_preview,
+        last_message_at=latest.last_message_at,
+        last_message_sender=latest.last_message_sender,
+        updated_at=Conversation.objects.filter(id__in=group).aggregate(Max('updated_at'))['updated_at__max'],
+    )
+
+    # Keep each participant's furthest watermark and recount what lies past it
+    for user_id in user_ids:
+        watermark = ReadState.objects.filter(conversation_id__in=group, user_id=user_id).aggregate(
+            Max('last_read_message_id')
+        )['last_read_message_id__max'] or 0
+        unread = Message.objects.filter(conversation_id=keep, id__gt=watermark).exclude(sender_id=user_id).count()
+        ReadState.objects.update_or_create(
+            conversation_id=keep, user_id=user_id,
+            defaults={'last_read_message_id': watermark, 'unread_count': unread},
+        )
+    Conversation.objects.filter(id__in=duplicates).delete()
+
+
+def assign_direct_keys(apps, schema_editor):
+    """Merge duplicate one-to-one conversations, then key the survivors"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Membership = Conversation.participants.through
+
+    members = defaultdict(list)
+    for conversation_id, user_id in Membership.objects.order_by('conversation_id', 'user_id').values_list(
+        'conversation_id', 'user_id'
+    ).iterator(chunk_size=2000):
+        members[conversation_id].append(user_id)
+
+    pairs = defaultdict(list)
+    for conversation_id, user_ids in members.items():
+        if len(user_ids) == 2:
+            pairs[tuple(user_ids)].append(conversation_id)
+
+    for user_ids, conversation_ids in pairs.items():
+        keep, *duplicates = sorted(conversation_ids)
+        if duplicates:
+            merge_conversations(apps, schema_editor.connection, keep, duplicates, user_ids)
+        Conversation.objects.filter(id=keep).update(direct_key='%d:%d' % user_ids)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_username_prefix_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='direct_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(assign_direct_keys, migrations.RunPython.noop),
+    ]
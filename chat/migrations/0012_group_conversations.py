@@ -0,0 +1,50 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_members(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    Membership = Conversation.participants.through
+    members = (
+        Membership.objects.filter(conversation_id=OuterRef('pk'))
+        .values('conversation_id')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    Conversation.objects.update(member_count=Coalesce(Subquery(members, output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0011_conversation_direct_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='admins',
+            field=models.ManyToManyField(blank=True, related_name='administered_conversations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='is_group',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
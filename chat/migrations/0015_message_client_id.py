@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-19 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_backgroundtask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='client_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(('client_id__isnull', False)),
+                fields=('conversation', 'sender', 'client_id'),
+                name='chat_msg_client_id_uniq',
+            ),
+        ),
+    ]
@@ -1,17 +1,51 @@
-from django.db import models
+import uuid
+
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
+from . import metrics, pagecache
+
+
+PREVIEW_LENGTH = 100
+# Longest client-generated message id (a UUID string fits comfortably)
+CLIENT_ID_MAX_LENGTH = 64
+# Members kept in a group's participant_summary; the full list is paginated
+GROUP_SUMMARY_MEMBERS = 5
 
 
 class Conversation(models.Model):
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    # Denormalized summary so the conversation list never touches Message
+    # or the participants table.
+    last_message = models.ForeignKey(
+        'Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
+    last_message_preview = models.CharField(max_length=255, blank=True, default='')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_sender = models.CharField(max_length=150, blank=True, default='')
+    participant_summary = models.JSONField(default=list, blank=True)
+    # Sequence number of the latest message; see allocate_seq()
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # "<lower user id>:<higher user id>" for one-to-one chats, so every pair
+    # has at most one; NULL for any other conversation
+    direct_key = models.CharField(max_length=41, null=True, blank=True, unique=True, editable=False)
+    # Group chats have a name and admins, and may have thousands of members
+    is_group = models.BooleanField(default=False)
+    name = models.CharField(max_length=100, blank=True, default='')
+    admins = models.ManyToManyField(User, related_name='administered_conversations', blank=True)
+    member_count = models.PositiveIntegerField(default=0)
     
     class Meta:
         ordering = ['-updated_at']
     
     def __str__(self):
+        if self.is_group:
+            return self.name or f"Group {self.id}"
         participants = list(self.participants.all())
         if len(participants) >= 2:
             return f"{participants[0].username} & {participants[1].username}"
@@ -21,36 +55,467 @@ class Conversation(models.Model):
     
     def get_display_name(self, current_user):
         """Get conversation name for display to a specific user"""
-        participants = list(self.participants.all())
+        if self.is_group:
+            return self.name or "Group"
+        participants = self.participant_summary
         # For direct messages, show the other participant's name
         for participant in participants:
-            if participant != current_user:
-                return participant.username
+            if participant['id'] != current_user.id:
+                return participant['username']
         # If only current user (shouldn't happen), show their name
         return current_user.username if participants else "Unknown"
     
+    @staticmethod
+    def direct_key_for(user_id, other_user_id):
+        low, high = sorted((user_id, other_user_id))
+        return f'{low}:{high}'
+
+    @classmethod
+    def get_or_create_direct(cls, user, other_user):
+        """The one-to-one conversation of two users, created on first use.
+
+        A single lookup on the unique ``direct_key``; of two concurrent
+        creations, the loser's INSERT fails and get_or_create returns the
+        winner's row. Returns ``(conversation, created)``.
+        """
+        with transaction.atomic():
+            conversation, created = cls.objects.get_or_create(
+                direct_key=cls.direct_key_for(user.id, other_user.id)
+            )
+            if created:
+                conversation.participants.add(user, other_user)
+        return conversation, created
+
+    @classmethod
+    def create_group(cls, name, creator, members=()):
+        """A new group conversation; its creator becomes the first admin"""
+        with transaction.atomic():
+            conversation = cls.objects.create(name=name, is_group=True)
+            conversation.participants.add(creator, *members)
+            conversation.admins.add(creator)
+        return conversation
+
+    def is_admin(self, user):
+        return self.admins.filter(id=user.id).exists()
+
+    def remove_member(self, user_id):
+        """Remove a member; a group left without admins promotes its lowest-id member"""
+        with transaction.atomic():
+            self.participants.remove(user_id)
+            if self.is_group and not self.admins.exists():
+                successor = self.participants.order_by('id').values_list('id', flat=True).first()
+                if successor is not None:
+                    self.admins.add(successor)
+
+    def members_page(self, after_id=0, limit=100):
+        """Members with a user id above ``after_id``; returns ``(members, has_more)``.
+
+        Keyset pagination over the participants table's (conversation, user)
+        index, so every page costs the same however large the group is.
+        """
+        rows = list(
+            Conversation.participants.through.objects.filter(conversation_id=self.id, user_id__gt=after_id)
+            .order_by('user_id')
+            .values_list('user_id', 'user__username')[:limit + 1]
+        )
+        page = rows[:limit]
+        admins = set(self.admins.filter(id__in=[user_id for user_id, _ in page]).values_list('id', flat=True))
+        members = [
+            {'id': user_id, 'username': username, 'is_admin': user_id in admins}
+            for user_id, username in page
+        ]
+        return members, len(rows) > limit
+
     def get_last_message(self):
         return self.messages.order_by('-timestamp').first()
 
+    @classmethod
+    def allocate_seq(cls, conversation_id, count=1):
+        """Reserve ``count`` consecutive message sequence numbers; returns the last one.
+
+        The UPDATE row-locks the conversation until the surrounding
+        transaction ends, so sequence numbers become visible in order.
+        """
+        if connection.features.can_return_columns_from_insert:
+            table = connection.ops.quote_name(cls._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET last_seq = last_seq + %s WHERE id = %s RETURNING last_seq',
+                    [count, conversation_id]
+                )
+                row = cursor.fetchone()
+            last_seq = row[0] if row else None
+        else:
+            cls.objects.filter(id=conversation_id).update(last_seq=F('last_seq') + count)
+            last_seq = cls.objects.filter(id=conversation_id).values_list('last_seq', flat=True).first()
+        if last_seq is None:
+            raise cls.DoesNotExist(f'Conversation {conversation_id} does not exist')
+        return last_seq
+
+    @classmethod
+    def record_messages(cls, conversation_id, messages, updated_at):
+        """Apply newly inserted ``messages`` (in id order) to the summary and read states"""
+        cls.objects.filter(id=conversation_id).update(
+            updated_at=updated_at,
+            **cls.summary_for_message(messages[-1])
+        )
+        ReadState.record_messages(conversation_id, messages)
+        pagecache.bump_conversations([conversation_id])
+
+    @staticmethod
+    def summary_for_message(message):
+        """Summary field values describing ``message`` as the latest one"""
+        return {
+            'last_message': message,
+            'last_message_preview': message.preview,
+            'last_message_at': message.timestamp,
+            'last_message_sender': message.sender.username,
+        }
+
+    def refresh_participant_summary(self, save=True):
+        members = self.participants.order_by('id').only('id', 'username')
+        if self.is_group:
+            # A short preview plus the count, never the whole member list
+            self.member_count = members.count()
+            members = members[:GROUP_SUMMARY_MEMBERS]
+        self.participant_summary = [{'id': user.id, 'username': user.username} for user in members]
+        if not self.is_group:
+            self.member_count = len(self.participant_summary)
+        if save:
+            Conversation.objects.filter(id=self.id).update(
+                participant_summary=self.participant_summary,
+                member_count=self.member_count
+            )
+
+    def refresh_summary(self, save=True):
+        """Recompute every denormalized field from the source tables"""
+        last_message = self.messages.select_related('sender', 'attachment').order_by('-timestamp', '-id').first()
+        if last_message:
+            values = self.summary_for_message(last_message)
+        else:
+            values = {
+                'last_message': None,
+                'last_message_preview': '',
+                'last_message_at': None,
+                'last_message_sender': '',
+            }
+        for field, value in values.items():
+            setattr(self, field, value)
+        self.refresh_participant_summary(save=False)
+        if save:
+            values['participant_summary'] = self.participant_summary
+            values['member_count'] = self.member_count
+            Conversation.objects.filter(id=self.id).update(**values)
+            pagecache.bump_conversations([self.id], rooms=True)
+
+    def to_summary_dict(self, current_user):
+        """Conversation list entry, built from the denormalized summary only"""
+        display_name = self.get_display_name(current_user)
+        return {
+            'id': self.id,
+            'name': display_name,
+            'avatar_initial': display_name[0].upper() if display_name else '?',
+            'last_message': self.last_message_preview,
+            'last_message_time': self.last_message_at.isoformat() if self.last_message_at else '',
+            'last_message_id': self.last_message_id,
+            'last_message_sender': self.last_message_sender,
+            'participants': [
+                p['username'] for p in self.participant_summary if p['id'] != current_user.id
+            ],
+            # Presence is only shown for one-to-one chats
+            'participant_ids': [] if self.is_group else [
+                p['id'] for p in self.participant_summary if p['id'] != current_user.id
+            ],
+            'is_group': self.is_group,
+            'member_count': self.member_count,
+            'unread_count': getattr(self, 'unread_count', 0),
+        }
+
 
 class Message(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
-    is_read = models.BooleanField(default=False)
+    # Gapless per-conversation position, used to resume after a reconnect
+    seq = models.PositiveBigIntegerField()
+    attachment = models.ForeignKey(
+        'Attachment', on_delete=models.SET_NULL, null=True, blank=True, related_name='messages'
+    )
+    # Sender-chosen id that makes a retried send idempotent (see chat.dedup)
+    client_id = models.CharField(max_length=CLIENT_ID_MAX_LENGTH, null=True, blank=True)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Backs keyset pagination of a conversation's history
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_msg_conv_ts_id_idx'),
+        ]
+        constraints = [
+            # Also backs the "messages after seq N" reconnect delta
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='chat_msg_conv_seq_uniq'),
+            models.UniqueConstraint(
+                fields=['conversation', 'sender', 'client_id'],
+                condition=models.Q(client_id__isnull=False),
+                name='chat_msg_client_id_uniq',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}..."
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.seq is None:
+            self.seq = Conversation.allocate_seq(self.conversation_id)
+        super().save(*args, **kwargs)
     
+    @property
+    def preview(self):
+        """Conversation list text for this message"""
+        if not self.content and self.attachment_id is not None:
+            return f'Attachment: {self.attachment.filename}'[:PREVIEW_LENGTH]
+        return self.content[:PREVIEW_LENGTH]
+
     def to_dict(self):
-        return {
+        data = {
             'id': self.id,
+            'seq': self.seq,
             'sender': self.sender.username,
             'content': self.content,
             'timestamp': self.timestamp.isoformat(),
-            'is_read': self.is_read,
         }
+        if self.attachment_id is not None:
+            data['attachment'] = self.attachment.to_ref()
+        if self.client_id is not None:
+            data['client_id'] = self.client_id
+        return data
+
+
+class ArchiveSegment(models.Model):
+    """Compressed, immutable run of a conversation's oldest messages.
+
+    ``data`` holds the messages' ``to_dict()`` in history order as
+    zlib-compressed JSON. The other columns index the segment, so history
+    reads only decompress the segments they actually need.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archive_segments')
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    min_message_id = models.BigIntegerField()
+    max_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'last_timestamp'], name='chat_archive_conv_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.conversation_id}: {self.message_count} messages up to {self.last_timestamp}"
+
+
+class MediaFile(models.Model):
+    """Stored attachment bytes, shared by every upload of identical content.
+
+    ``file`` is named after the content's SHA-256, so a second upload of the
+    same file only adds an ``Attachment`` row. Dimensions and the thumbnail
+    are filled in by a background worker (see ``chat.media``).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveBigIntegerField()
+    file = models.FileField(max_length=200)
+    content_type = models.CharField(max_length=100, blank=True, default='')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail = models.FileField(max_length=200, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
+class Attachment(models.Model):
+    """A file a user uploads into a conversation, in resumable chunks.
+
+    ``received`` counts the bytes written so far; once all ``size`` bytes are
+    in, the upload is linked to its deduplicated ``media``. Participants of
+    ``conversation`` may download it.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachments')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    media = models.ForeignKey(
+        MediaFile, on_delete=models.PROTECT, null=True, blank=True, related_name='attachments'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+    @property
+    def complete(self):
+        return self.media_id is not None
+
+    def to_ref(self):
+        """Compact reference carried by messages; the bytes are fetched separately"""
+        return {
+            'id': str(self.id),
+            'name': self.filename,
+            'size': self.size,
+            'content_type': self.content_type,
+        }
+
+
+class ReadState(models.Model):
+    """Per-participant read watermark and unread counter for a conversation.
+
+    Every message with an id up to ``last_read_message_id`` counts as read by
+    ``user``; ``unread_count`` is maintained incrementally on each write.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='chat_readstate_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.conversation_id} up to {self.last_read_message_id}"
+
+    @classmethod
+    def record_messages(cls, conversation_id, messages):
+        """Bump unread counters for new ``messages`` (in id order) with one UPDATE.
+
+        A sender has implicitly read everything up to their own latest
+        message, so their watermark moves there instead.
+        """
+        last_own = {}
+        for message in messages:
+            last_own[message.sender_id] = message.id
+        watermark_whens = []
+        unread_whens = []
+        for sender_id, message_id in last_own.items():
+            unread_after = sum(
+                1 for message in messages if message.id > message_id and message.sender_id != sender_id
+            )
+            watermark_whens.append(When(user_id=sender_id, then=Value(message_id)))
+            unread_whens.append(When(user_id=sender_id, then=Value(unread_after)))
+
+        # One row per participant, so the row count doubles as the group size
+        members = cls.objects.filter(conversation_id=conversation_id).update(
+            last_read_message_id=Case(
+                *watermark_whens, default=F('last_read_message_id'), output_field=models.BigIntegerField()
+            ),
+            unread_count=Case(
+                *unread_whens, default=F('unread_count') + len(messages), output_field=IntegerField()
+            ),
+        )
+        metrics.GROUP_SIZE.observe(members)
+
+    @classmethod
+    def mark_read(cls, conversation_id, user_id, message_id):
+        """Move a user's watermark forward to ``message_id`` in a single UPDATE.
+
+        The watermark never moves backwards nor past the conversation's last
+        message. Returns whether it moved.
+        """
+        still_unread = (
+            Message.objects.filter(conversation_id=conversation_id, id__gt=message_id)
+            .exclude(sender_id=user_id)
+            .values('conversation_id')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        moved = cls.objects.filter(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            last_read_message_id__lt=message_id,
+            conversation__last_message_id__gte=message_id,
+        ).update(
+            last_read_message_id=message_id,
+            unread_count=Coalesce(Subquery(still_unread), 0),
+        ) > 0
+        if moved:
+            # The unread count in this user's conversation list changed
+            pagecache.bump_users([user_id])
+        return moved
+
+    @classmethod
+    def unread_for(cls, conversation_id, user_id):
+        """A user's current unread count in one conversation"""
+        return cls.objects.filter(conversation_id=conversation_id, user_id=user_id).values_list(
+            'unread_count', flat=True
+        ).first() or 0
+
+    @classmethod
+    def watermarks(cls, conversation_id):
+        """Map of username to last read message id for a conversation"""
+        return dict(
+            cls.objects.filter(conversation_id=conversation_id)
+            .values_list('user__username', 'last_read_message_id')
+        )
+
+    @classmethod
+    def unread_count_subquery(cls, user):
+        """Annotation giving ``user``'s unread count per conversation"""
+        return Coalesce(
+            Subquery(
+                cls.objects.filter(conversation_id=OuterRef('pk'), user=user).values('unread_count')[:1]
+            ),
+            0,
+        )
+
+
+class UserPresence(models.Model):
+    """Last time a user was seen online, persisted lazily by chat.presence"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='presence')
+    last_seen = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user_id} last seen {self.last_seen}"
+
+    @classmethod
+    def save_last_seen(cls, last_seen):
+        """Upsert ``{user_id: datetime}`` in one statement, skipping deleted users"""
+        existing = User.objects.filter(id__in=last_seen).values_list('id', flat=True)
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, last_seen=last_seen[user_id]) for user_id in existing],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['last_seen'],
+        )
+
+
+class BackgroundTask(models.Model):
+    """A durable ``chat.tasks`` job, stored in the transaction that queued it.
+
+    Workers claim due rows by setting ``locked_until``; a worker that dies
+    mid-task leaves a lease that simply expires. Rows are deleted once they
+    succeed, and kept with ``failed_at`` after the last retry.
+    """
+    func = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    failed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed_at', 'run_after'], name='chat_task_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.func} (attempt {self.attempts})"
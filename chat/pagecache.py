@@ -0,0 +1,111 @@
+"""Per-user response cache for the conversation list and chat room fragments.
+
+Each cached page remembers the version tokens of everything it was built
+from: the user (their memberships and read states), every listed
+conversation (its messages) and each room (its name and members). Writes
+replace those tokens after commit, so a page is served from the cache only
+while all of them are unchanged - checking that is one ``get_many`` and no
+database queries. The page's ETag is derived from the same tokens.
+"""
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+
+def user_key(user_id):
+    return f'chat:v:user:{user_id}'
+
+
+def conversation_key(conversation_id):
+    return f'chat:v:conv:{conversation_id}'
+
+
+def room_key(conversation_id):
+    return f'chat:v:room:{conversation_id}'
+
+
+def conversation_list_page(user_id):
+    return f'chat:page:conversations:{user_id}'
+
+
+def room_page(conversation_id, user_id):
+    return f'chat:page:room:{conversation_id}:{user_id}'
+
+
+def current_versions(keys):
+    """Current token of each version key, creating the ones not set yet"""
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    for key in missing:
+        # add() keeps a token a concurrent bump stored in the meantime
+        cache.add(key, uuid.uuid4().hex, None)
+    if missing:
+        versions.update(cache.get_many(missing))
+    return versions
+
+
+def bump(keys):
+    """Invalidate every page built against ``keys`` once the transaction commits"""
+    keys = list(keys)
+    if not keys:
+        return
+
+    def replace():
+        cache.set_many({key: uuid.uuid4().hex for key in keys}, None)
+
+    if transaction.get_connection().in_atomic_block:
+        # Also right away, for reads in the same transaction; a page another
+        # request rebuilt before the commit is dropped by the second bump
+        replace()
+    transaction.on_commit(replace)
+
+
+def bump_users(user_ids):
+    bump(user_key(user_id) for user_id in user_ids)
+
+
+def bump_conversations(conversation_ids, rooms=False):
+    keys = [conversation_key(conversation_id) for conversation_id in conversation_ids]
+    if rooms:
+        keys += [room_key(conversation_id) for conversation_id in conversation_ids]
+    bump(keys)
+
+
+def get_page(page_key):
+    """The cached page under ``page_key``, if every version it was built from is current"""
+    page = cache.get(page_key)
+    if page is None or cache.get_many(list(page['versions'])) != page['versions']:
+        return None
+    return page
+
+
+def store_page(page_key, versions, content, content_type):
+    """Cache a rendered page; ``versions`` must have been read before rendering it"""
+    digest = hashlib.sha1(json.dumps(sorted(versions.items())).encode()).hexdigest()
+    page = {
+        'versions': versions,
+        'etag': f'"{digest}"',
+        'content': content,
+        'content_type': content_type,
+    }
+    cache.set(page_key, page, getattr(settings, 'CHAT_PAGE_CACHE_SECONDS', 600))
+    return page
+
+
+def page_etag(request, page_key):
+    """ETag for ``condition()``; the page is kept on the request for the view"""
+    request.cached_page = get_page(page_key)
+    return request.cached_page['etag'] if request.cached_page else None
+
+
+def page_response(page):
+    response = HttpResponse(page['content'], content_type=page['content_type'])
+    response['ETag'] = page['etag']
+    # Per user, and revalidated on every use
+    response['Cache-Control'] = 'private, no-cache'
+    return response
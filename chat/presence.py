@@ -0,0 +1,469 @@
+"""Online status and last-seen tracking.
+
+Sessions (one per socket) live in the presence backend, never in the
+database: an in-process dict for development, or Redis so every worker sees
+the same state. A session stays alive for ``CHAT_PRESENCE_TTL_SECONDS``
+after its last heartbeat, so sockets of a crashed worker expire on their
+own: every service sweeps for them once per TTL and announces those users
+as offline. When a user's last session ends or expires, their last-seen time
+is queued and written to ``UserPresence`` in batches every
+``CHAT_PRESENCE_FLUSH_SECONDS``.
+"""
+import asyncio
+import threading
+import time
+import weakref
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .db import database_sync_to_async
+from .fanout import fan_out
+from .groups import conversation_group
+from .models import Conversation, UserPresence
+from .wire import frame_event
+
+try:
+    import redis
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis is in requirements.txt
+    redis = aioredis = None
+
+
+def to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc) if timestamp is not None else None
+
+
+class InMemoryPresenceBackend:
+    """Process-local sessions; only correct with a single worker process"""
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.sessions = {}
+        self.last_seen = {}
+        self.pending = {}
+        # Users whose last session timed out, until the next sweep
+        self.expired = {}
+        self.lock = threading.Lock()
+
+    def _live(self, user_id, now):
+        sessions = self.sessions.get(user_id)
+        if sessions is None:
+            return 0
+        latest = max(sessions.values(), default=None)
+        for session_id, expires in list(sessions.items()):
+            if expires <= now:
+                del sessions[session_id]
+        if not sessions:
+            del self.sessions[user_id]
+            if latest is not None:
+                # Timed out rather than disconnected: last seen at the last heartbeat
+                self.last_seen[user_id] = self.pending[user_id] = self.expired[user_id] = latest - self.ttl
+            return 0
+        return len(sessions)
+
+    async def connect(self, user_id, session_id):
+        """Start a session; returns whether the user just came online"""
+        now = self.clock()
+        with self.lock:
+            was_online = self._live(user_id, now) > 0
+            self.expired.pop(user_id, None)
+            self.sessions.setdefault(user_id, {})[session_id] = now + self.ttl
+        return not was_online
+
+    async def heartbeat(self, user_id, session_id):
+        now = self.clock()
+        with self.lock:
+            sessions = self.sessions.get(user_id)
+            if sessions is not None and session_id in sessions:
+                sessions[session_id] = now + self.ttl
+
+    async def disconnect(self, user_id, session_id):
+        """End a session; returns whether the user just went offline"""
+        now = self.clock()
+        with self.lock:
+            self.sessions.get(user_id, {}).pop(session_id, None)
+            if self._live(user_id, now):
+                return False
+            self.expired.pop(user_id, None)
+            self.last_seen[user_id] = self.pending[user_id] = now
+        return True
+
+    def read_statuses(self, user_ids):
+        """``{user_id: (online, last_seen timestamp or None)}``"""
+        now = self.clock()
+        with self.lock:
+            return {
+                user_id: (self._live(user_id, now) > 0, self.last_seen.get(user_id))
+                for user_id in user_ids
+            }
+
+    async def statuses(self, user_ids):
+        return self.read_statuses(user_ids)
+
+    async def expire_sessions(self):
+        """Drop timed-out sessions; ``{user_id: last_seen}`` of the users they left offline"""
+        now = self.clock()
+        with self.lock:
+            for user_id in list(self.sessions):
+                self._live(user_id, now)
+            expired, self.expired = self.expired, {}
+        return expired
+
+    async def drain_last_seen(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+
+class RedisPresenceBackend:
+    """Sessions in Redis, shared by every worker.
+
+    Each user has a sorted set of session ids scored by expiry time, and one
+    more sorted set scores every online user by their latest expiry so that
+    timed-out users can be found. Last-seen times live in one hash, plus a
+    second hash of not yet persisted entries. ``sync_redis`` serves
+    ``read_statuses`` for synchronous callers.
+    """
+
+    prefix = 'chat:presence'
+
+    def __init__(self, url, ttl, clock=time.time):
+        # Neither client connects before its first command
+        self.redis = aioredis.from_url(url)
+        self.sync_redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.clock = clock
+        self.expiries_key = f'{self.prefix}:expiries'
+        self.last_seen_key = f'{self.prefix}:last_seen'
+        self.pending_key = f'{self.prefix}:last_seen:pending'
+
+    def _sessions_key(self, user_id):
+        return f'{self.prefix}:sessions:{user_id}'
+
+    async def connect(self, user_id, session_id):
+        now = self.clock()
+        key = self._sessions_key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            pipe.zadd(key, {session_id: now + self.ttl})
+            pipe.expire(key, int(self.ttl) + 1)
+            pipe.zadd(self.expiries_key, {user_id: now + self.ttl}, gt=True)
+            _, live, _, _, _ = await pipe.execute()
+        return live == 0
+
+    async def heartbeat(self, user_id, session_id):
+        key = self._sessions_key(user_id)
+        expires = self.clock() + self.ttl
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(key, {session_id: expires}, xx=True)
+            pipe.expire(key, int(self.ttl) + 1)
+            pipe.zadd(self.expiries_key, {user_id: expires}, gt=True)
+            await pipe.execute()
+
+    async def disconnect(self, user_id, session_id):
+        now = self.clock()
+        key = self._sessions_key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(key, session_id)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            _, _, live = await pipe.execute()
+        if live:
+            return False
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.expiries_key, user_id)
+            pipe.hset(self.last_seen_key, user_id, now)
+            pipe.hset(self.pending_key, user_id, now)
+            await pipe.execute()
+        return True
+
+    def _queue_statuses(self, pipe, user_ids):
+        now = self.clock()
+        for user_id in user_ids:
+            pipe.zcount(self._sessions_key(user_id), now, '+inf')
+        pipe.hmget(self.last_seen_key, user_ids)
+
+    def _parse_statuses(self, user_ids, results):
+        *counts, last_seen = results
+        return {
+            user_id: (count > 0, float(seen) if seen is not None else None)
+            for user_id, count, seen in zip(user_ids, counts, last_seen)
+        }
+
+    async def statuses(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self._queue_statuses(pipe, user_ids)
+            return self._parse_statuses(user_ids, await pipe.execute())
+
+    def read_statuses(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        with self.sync_redis.pipeline(transaction=False) as pipe:
+            self._queue_statuses(pipe, user_ids)
+            return self._parse_statuses(user_ids, pipe.execute())
+
+    async def expire_sessions(self):
+        now = self.clock()
+        due = await self.redis.zrangebyscore(self.expiries_key, '-inf', now, withscores=True)
+        expired = {}
+        for member, expires in due:
+            # Whichever worker removes the entry handles the user
+            if not await self.redis.zrem(self.expiries_key, member):
+                continue
+            key = self._sessions_key(int(member))
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.zrange(key, -1, -1, withscores=True)
+                _, latest = await pipe.execute()
+            if latest:
+                # Reconnected since the entry was read; keep tracking them
+                await self.redis.zadd(self.expiries_key, {member: latest[0][1]}, gt=True)
+                continue
+            seen = expires - self.ttl
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(self.last_seen_key, member, seen)
+                pipe.hset(self.pending_key, member, seen)
+                await pipe.execute()
+            expired[int(member)] = seen
+        return expired
+
+    async def drain_last_seen(self):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self.pending_key)
+            pipe.delete(self.pending_key)
+            pending, _ = await pipe.execute()
+        return {int(user_id): float(seen) for user_id, seen in pending.items()}
+
+
+_memory_backend = None
+_status_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend():
+    ttl = getattr(settings, 'CHAT_PRESENCE_TTL_SECONDS', 60)
+    if getattr(settings, 'CHAT_PRESENCE_BACKEND', 'memory') == 'redis':
+        return RedisPresenceBackend(settings.CHAT_PRESENCE_REDIS_URL, ttl)
+
+    # Shared by every event loop of the process
+    global _memory_backend
+    with _backend_lock:
+        if _memory_backend is None:
+            _memory_backend = InMemoryPresenceBackend(ttl)
+        return _memory_backend
+
+
+def status_backend():
+    """Backend for synchronous status reads, one per process"""
+    if getattr(settings, 'CHAT_PRESENCE_BACKEND', 'memory') != 'redis':
+        return create_backend()
+    global _status_backend
+    with _backend_lock:
+        if _status_backend is None:
+            _status_backend = create_backend()
+        return _status_backend
+
+
+def load_last_seen(user_ids):
+    """Persisted last-seen times, for users the backend has none for"""
+    return dict(UserPresence.objects.filter(user_id__in=user_ids).values_list('user_id', 'last_seen'))
+
+
+def unknown_last_seen(statuses):
+    return [user_id for user_id, (online, seen) in statuses.items() if not online and seen is None]
+
+
+def describe_statuses(statuses, persisted):
+    """``{user_id: {'online': bool, 'last_seen': datetime or None}}``"""
+    return {
+        user_id: {
+            'online': online,
+            'last_seen': to_datetime(seen) if seen is not None else persisted.get(user_id),
+        }
+        for user_id, (online, seen) in statuses.items()
+    }
+
+
+class PresenceService:
+    """Presence hooks for the consumers of one event loop.
+
+    Status changes are broadcast to every one-to-one conversation of the
+    user, whichever socket caused them, at most once per ``window`` seconds
+    per user: a user flapping between online and offline inside the window
+    produces one trailing broadcast of their final state, or none if nothing
+    changed.
+
+    Sessions that time out are found by a sweep every ``sweep_interval``
+    seconds (the backend's TTL by default) and announced the same way.
+    """
+
+    def __init__(self, backend, channel_layer, window, flush_interval, sweep_interval=None):
+        self.backend = backend
+        self.channel_layer = channel_layer
+        self.window = window
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval or backend.ttl
+        self.broadcasts = {}
+        self.flush_handle = None
+        self.sweep_handle = None
+        self.tasks = set()
+
+    async def connected(self, user, session_id):
+        self._schedule_sweep()
+        if await self.backend.connect(user.id, session_id):
+            await self._announce(user)
+
+    async def heartbeat(self, user, session_id):
+        await self.backend.heartbeat(user.id, session_id)
+
+    async def disconnected(self, user, session_id):
+        if await self.backend.disconnect(user.id, session_id):
+            self._schedule_flush()
+            await self._announce(user)
+
+    async def statuses(self, user_ids):
+        statuses = await self.backend.statuses(user_ids)
+        missing = unknown_last_seen(statuses)
+        persisted = await database_sync_to_async(load_last_seen)(missing) if missing else {}
+        return describe_statuses(statuses, persisted)
+
+    async def flush(self):
+        """Persist queued last-seen times in one upsert"""
+        pending = await self.backend.drain_last_seen()
+        if pending:
+            await self._save_last_seen(pending)
+
+    async def sweep(self):
+        """Announce users whose last session timed out instead of closing"""
+        expired = await self.backend.expire_sessions()
+        if not expired:
+            return
+        self._schedule_flush()
+        for user in await self._load_users(list(expired)):
+            await self._announce(user)
+
+    async def _announce(self, user):
+        state = self.broadcasts.get(user.id)
+        if state is None:
+            state = self.broadcasts[user.id] = {'online': None, 'at': float('-inf'), 'handle': None}
+        state['user'] = user
+        if state['handle'] is not None:
+            # A trailing broadcast is already due; it reads the latest state
+            return
+        loop = asyncio.get_running_loop()
+        wait = state['at'] + self.window - loop.time()
+        if wait <= 0:
+            await self._broadcast(user.id)
+        else:
+            state['handle'] = loop.call_later(wait, lambda: self._spawn(self._broadcast(user.id)))
+
+    async def _broadcast(self, user_id):
+        state = self.broadcasts.get(user_id)
+        if state is None:
+            return
+        state['handle'] = None
+        online, seen = (await self.backend.statuses([user_id]))[user_id]
+        if online == state['online']:
+            return
+        loop = asyncio.get_running_loop()
+        state['online'] = online
+        state['at'] = loop.time()
+        if not online:
+            # Keep the entry for one window so the rate limit holds
+            loop.call_later(self.window, self._discard_if_idle, user_id, state)
+
+        user = state['user']
+        event = frame_event('presence', {
+            'type': 'presence',
+            'user_id': user.id,
+            'username': user.username,
+            'online': online,
+            'last_seen': None if online else to_datetime(seen or self.backend.clock()).isoformat(),
+        }, user_id=user.id)
+        await fan_out(self.channel_layer, await self._load_presence_groups(user.id), event)
+
+    def _discard_if_idle(self, user_id, state):
+        if self.broadcasts.get(user_id) is state and state['handle'] is None and not state['online']:
+            del self.broadcasts[user_id]
+
+    def _schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: self._spawn(self._flush_later())
+            )
+
+    async def _flush_later(self):
+        self.flush_handle = None
+        await self.flush()
+
+    def _schedule_sweep(self):
+        if self.sweep_handle is None:
+            self.sweep_handle = asyncio.get_running_loop().call_later(
+                self.sweep_interval, lambda: self._spawn(self._sweep_later())
+            )
+
+    async def _sweep_later(self):
+        self.sweep_handle = None
+        try:
+            await self.sweep()
+        finally:
+            self._schedule_sweep()
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    @database_sync_to_async
+    def _load_presence_groups(self, user_id):
+        """Groups of the user's one-to-one conversations; groups do not show status"""
+        return [
+            conversation_group(conversation_id)
+            for conversation_id in Conversation.participants.through.objects.filter(
+                user_id=user_id, conversation__is_group=False
+            ).values_list('conversation_id', flat=True)
+        ]
+
+    @database_sync_to_async
+    def _load_users(self, user_ids):
+        return list(User.objects.filter(id__in=user_ids))
+
+    @database_sync_to_async
+    def _save_last_seen(self, pending):
+        UserPresence.save_last_seen({user_id: to_datetime(seen) for user_id, seen in pending.items()})
+
+
+_services = weakref.WeakKeyDictionary()
+
+
+def get_presence(channel_layer):
+    """The presence service for the running event loop"""
+    loop = asyncio.get_running_loop()
+    service = _services.get(loop)
+    if service is None or service.channel_layer is not channel_layer:
+        service = _services[loop] = PresenceService(
+            create_backend(),
+            channel_layer,
+            window=getattr(settings, 'CHAT_PRESENCE_BROADCAST_WINDOW_SECONDS', 5),
+            flush_interval=getattr(settings, 'CHAT_PRESENCE_FLUSH_SECONDS', 30),
+        )
+    return service
+
+
+def fetch_statuses(user_ids):
+    """Bulk status lookup for synchronous callers such as views.
+
+    Reads through the process-wide ``status_backend()``, never a per-loop
+    service, so no event loop or Redis client is created per request.
+    """
+    statuses = status_backend().read_statuses(user_ids)
+    missing = unknown_last_seen(statuses)
+    return describe_statuses(statuses, load_last_seen(missing) if missing else {})
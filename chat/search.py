@@ -0,0 +1,234 @@
+"""Full-text message search.
+
+The backend is picked from the database vendor (or ``CHAT_SEARCH_BACKEND``):
+
+* SQLite keeps an FTS5 external-content table, ``chat_message_fts``, which
+  a background task (``index_message_ids``) appends new messages to.
+* PostgreSQL relies on a GIN index over ``to_tsvector('simple', content)``,
+  which the database maintains by itself.
+* Anything else falls back to an unranked substring scan.
+
+Both indexes are created by migration 0006; ``rebuild_search_index``
+rebuilds them in bulk.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Conversation, Message
+
+FTS_TABLE = 'chat_message_fts'
+TSVECTOR_CONFIG = 'simple'
+
+TERM_RE = re.compile(r'\w+')
+
+
+def get_page_size(limit):
+    default = getattr(settings, 'CHAT_SEARCH_PAGE_SIZE', 20)
+    maximum = getattr(settings, 'CHAT_SEARCH_MAX_PAGE_SIZE', 100)
+    try:
+        limit = int(limit) if limit is not None else default
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+class SearchBackend:
+    """Unindexed fallback: newest substring matches first"""
+
+    def index_messages(self, messages):
+        """Add freshly saved ``messages`` to the index"""
+
+    def index_ids(self, message_ids):
+        """Add the saved messages with ``message_ids`` to the index"""
+        self.index_messages(Message.objects.filter(id__in=message_ids).only('id', 'content'))
+
+    def remove_messages(self, messages):
+        """Drop ``messages`` (about to leave the message table) from the index"""
+
+    def rebuild(self):
+        """Rebuild the whole index; returns the number of indexed messages"""
+        return Message.objects.count()
+
+    def filter(self, queryset, query):
+        """Restrict a ``Message`` queryset to matches of ``query``"""
+        return queryset.filter(content__icontains=query)
+
+    def ranked_ids(self, user, query, conversation_id, offset, limit):
+        """Ids of the best ``limit`` matches visible to ``user``, best first"""
+        queryset = Message.objects.filter(conversation__participants=user)
+        if conversation_id is not None:
+            queryset = queryset.filter(conversation_id=conversation_id)
+        queryset = self.filter(queryset, query).order_by('-id')
+        return list(queryset.values_list('id', flat=True)[offset:offset + limit])
+
+    def search(self, user, query, conversation_id=None, offset=0, limit=None):
+        """One page of ranked matches in ``user``'s conversations.
+
+        Returns ``(results, has_more)`` where each result is a message dict
+        tagged with its ``conversation_id``.
+        """
+        limit = get_page_size(limit)
+        offset = max(0, int(offset or 0))
+        if not TERM_RE.search(query or ''):
+            return [], False
+
+        # Fetch one extra row to know whether another page exists
+        ids = self.ranked_ids(user, query, conversation_id, offset, limit + 1)
+        has_more = len(ids) > limit
+        ids = ids[:limit]
+
+        messages = Message.objects.filter(id__in=ids).select_related('sender', 'attachment').in_bulk()
+        results = []
+        for message_id in ids:
+            message = messages[message_id]
+            results.append({'conversation_id': message.conversation_id, **message.to_dict()})
+        return results, has_more
+
+    def _run(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    def _scope(self, user, conversation_id):
+        """JOIN and WHERE fragments limiting ``m`` to the user's conversations"""
+        participants = connection.ops.quote_name(Conversation.participants.through._meta.db_table)
+        join = f'JOIN {participants} p ON p.conversation_id = m.conversation_id'
+        where = 'p.user_id = %s'
+        params = [user.id]
+        if conversation_id is not None:
+            where += ' AND m.conversation_id = %s'
+            params.append(conversation_id)
+        return join, where, params
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 index ranked by bm25, with prefix matching on the last term"""
+
+    @staticmethod
+    def match_expression(query):
+        # Quote every term so user input can never be FTS5 syntax
+        terms = TERM_RE.findall(query)
+        if not terms:
+            return None
+        return ' '.join(f'"{term}"' for term in terms) + '*'
+
+    @staticmethod
+    def indexed_ids(ids):
+        """Those of ``ids`` already in the index, from FTS5's per-row docsize table"""
+        if not ids:
+            return set()
+        placeholders = ', '.join(['%s'] * len(ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id FROM {FTS_TABLE}_docsize WHERE id IN ({placeholders})', list(ids))
+            return {row[0] for row in cursor.fetchall()}
+
+    def index_messages(self, messages):
+        # Indexing runs as a background task, so a retry must not add a row twice
+        messages = list(messages)
+        indexed = self.indexed_ids([message.id for message in messages])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE}(rowid, content) VALUES (%s, %s)',
+                [(message.id, message.content) for message in messages if message.id not in indexed]
+            )
+
+    def index_ids(self, message_ids):
+        # One statement that reads the rows and skips those already indexed
+        if not message_ids:
+            return
+        messages = connection.ops.quote_name(Message._meta.db_table)
+        placeholders = ', '.join(['%s'] * len(message_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE}(rowid, content) SELECT id, content FROM {messages} '
+                f'WHERE id IN ({placeholders}) AND id NOT IN (SELECT id FROM {FTS_TABLE}_docsize)',
+                list(message_ids)
+            )
+
+    def remove_messages(self, messages):
+        # External-content tables need the indexed values to delete a row, and
+        # deleting one that was never indexed (its task still pending) corrupts it
+        messages = list(messages)
+        indexed = self.indexed_ids([message.id for message in messages])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', %s, %s)",
+                [(message.id, message.content) for message in messages if message.id in indexed]
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        return super().rebuild()
+
+    def filter(self, queryset, query):
+        expression = self.match_expression(query)
+        if expression is None:
+            return queryset.none()
+        return queryset.filter(
+            id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [expression])
+        )
+
+    def ranked_ids(self, user, query, conversation_id, offset, limit):
+        messages = connection.ops.quote_name(Message._meta.db_table)
+        join, where, params = self._scope(user, conversation_id)
+        return self._run(
+            f'SELECT m.id FROM {FTS_TABLE} '
+            f'JOIN {messages} m ON m.id = {FTS_TABLE}.rowid {join} '
+            f'WHERE {FTS_TABLE} MATCH %s AND {where} '
+            f'ORDER BY {FTS_TABLE}.rank, m.id DESC LIMIT %s OFFSET %s',
+            [self.match_expression(query)] + params + [limit, offset]
+        )
+
+
+class PostgresSearchBackend(SearchBackend):
+    """GIN-indexed tsvector search ranked by ts_rank"""
+
+    index_name = 'chat_message_content_tsv'
+    vector = f"to_tsvector('{TSVECTOR_CONFIG}', {{column}})"
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'REINDEX INDEX {self.index_name}')
+        return super().rebuild()
+
+    def filter(self, queryset, query):
+        messages = connection.ops.quote_name(Message._meta.db_table)
+        vector = self.vector.format(column='content')
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT id FROM {messages} WHERE {vector} @@ plainto_tsquery('{TSVECTOR_CONFIG}', %s)",
+            [query]
+        ))
+
+    def ranked_ids(self, user, query, conversation_id, offset, limit):
+        messages = connection.ops.quote_name(Message._meta.db_table)
+        vector = self.vector.format(column='m.content')
+        join, where, params = self._scope(user, conversation_id)
+        return self._run(
+            f"SELECT m.id FROM {messages} m {join}, plainto_tsquery('{TSVECTOR_CONFIG}', %s) query "
+            f'WHERE {vector} @@ query AND {where} '
+            f'ORDER BY ts_rank({vector}, query) DESC, m.id DESC LIMIT %s OFFSET %s',
+            [query] + params + [limit, offset]
+        )
+
+
+def index_message_ids(message_ids):
+    """Background task: add saved messages to the index"""
+    get_search_backend().index_ids(message_ids)
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return BACKENDS.get(connection.vendor, SearchBackend)()
@@ -0,0 +1,130 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import pagecache
+from .fanout import fan_out, send_to_conversation
+from .groups import fanout_shards, user_group
+from .models import Conversation, ReadState
+from .wire import frame_event
+
+
+def notify_membership_changed(conversation, removed_user_ids, added_user_ids=()):
+    """Tell connected consumers about removed (and, in groups, added) members.
+
+    Consumers of removed users drop their cached authorization;
+    ``removed_user_ids`` of ``None`` means every participant was removed.
+    Group members also get a ``members_changed`` frame.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    extra = {'conversation_id': conversation.id, 'removed_user_ids': removed_user_ids}
+    if conversation.is_group:
+        event = frame_event('membership_changed', {
+            'type': 'members_changed',
+            'conversation_id': conversation.id,
+            'added_user_ids': list(added_user_ids),
+            'removed_user_ids': removed_user_ids,
+            'member_count': conversation.member_count,
+        }, **extra)
+    else:
+        event = {'type': 'membership_changed', **extra}
+    async_to_sync(send_to_conversation)(
+        channel_layer, conversation.id, fanout_shards(conversation.is_group), event
+    )
+
+
+def notify_conversation_joined(conversation, user_ids):
+    """Subscribe the users' multiplexed sockets to a conversation"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = {
+        'type': 'conversation_joined',
+        'conversation_id': conversation.id,
+        'is_group': conversation.is_group,
+    }
+    async_to_sync(fan_out)(channel_layer, [user_group(user_id) for user_id in user_ids], event)
+
+
+def notify_members(conversation, action, user_ids):
+    if action == 'post_add':
+        notify_conversation_joined(conversation, user_ids)
+        if conversation.is_group:
+            notify_membership_changed(conversation, [], user_ids)
+    else:
+        notify_membership_changed(conversation, user_ids)
+
+
+def sync_read_states(conversation, action, user_ids):
+    """Create or drop read-state rows along with participants"""
+    if action == 'post_add':
+        # New members start with the existing history marked as read
+        ReadState.objects.bulk_create(
+            [
+                ReadState(
+                    conversation=conversation,
+                    user_id=user_id,
+                    last_read_message_id=conversation.last_message_id or 0
+                )
+                for user_id in user_ids
+            ],
+            ignore_conflicts=True
+        )
+    elif user_ids is None:
+        ReadState.objects.filter(conversation=conversation).delete()
+    else:
+        ReadState.objects.filter(conversation=conversation, user_id__in=user_ids).delete()
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep the participant summary and connected consumers in sync with the M2M table"""
+    if reverse and action == 'pre_clear':
+        # user.conversations.clear() does not report which rows it removed
+        instance._cleared_conversation_ids = list(
+            instance.conversations.values_list('id', flat=True)
+        )
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        # user.conversations.add(...) - instance is the user
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_conversation_ids', [])
+        conversations = list(Conversation.objects.filter(id__in=pk_set))
+        changed = {conversation.id: [instance.id] for conversation in conversations}
+    else:
+        conversations = [instance]
+        changed = {instance.id: sorted(pk_set) if pk_set is not None else None}
+
+    for conversation in conversations:
+        conversation.refresh_participant_summary()
+        sync_read_states(conversation, action, changed[conversation.id])
+        if conversation.is_group and action != 'post_add':
+            # Former members lose their admin role with their membership
+            removed = changed[conversation.id]
+            if removed is None:
+                conversation.admins.clear()
+            else:
+                conversation.admins.remove(*removed)
+        transaction.on_commit(
+            lambda conversation=conversation: notify_members(conversation, action, changed[conversation.id])
+        )
+
+    # Former members' lists were built against the conversation's version;
+    # new members' lists did not include it yet
+    pagecache.bump_conversations([conversation.id for conversation in conversations], rooms=True)
+    if action == 'post_add':
+        pagecache.bump_users([instance.id] if reverse else pk_set)
+
+
+@receiver(post_save, sender=Conversation)
+@receiver(post_delete, sender=Conversation)
+def conversation_changed(sender, instance, **kwargs):
+    """Renames (e.g. through the admin) and deletions show in lists and room headers"""
+    pagecache.bump_conversations([instance.id], rooms=True)
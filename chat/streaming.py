@@ -0,0 +1,41 @@
+"""Streaming response bodies that stay streamed under ASGI.
+
+Django's ASGI handler serves a synchronous ``streaming_content`` by first
+collecting all of it into a list (``sync_to_async(list)``), so an export or
+a large file would sit in memory whole. Under ASGI the iterator is
+therefore wrapped in an async one that advances it one chunk at a time in a
+worker thread; WSGI servers get the plain iterator.
+"""
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+
+async def iterate_in_thread(iterator, thread_sensitive=True):
+    """Async iterator over a sync ``iterator``, one ``next()`` per thread hop.
+
+    Keep ``thread_sensitive`` for iterators that hold a database cursor, so
+    every step runs on the request's own connection.
+    """
+    step = sync_to_async(next, thread_sensitive=thread_sensitive)
+    done = object()
+    try:
+        while True:
+            chunk = await step(iterator, done)
+            if chunk is done:
+                return
+            yield chunk
+    finally:
+        # The client may go away mid-stream; release the cursor or file now
+        if hasattr(iterator, 'close'):
+            await sync_to_async(iterator.close, thread_sensitive=thread_sensitive)()
+
+
+def is_asgi(request):
+    return isinstance(request, ASGIRequest)
+
+
+def response_body(request, iterable, thread_sensitive=True):
+    """``streaming_content`` for ``iterable`` suited to the server running ``request``"""
+    if is_asgi(request):
+        return iterate_in_thread(iter(iterable), thread_sensitive)
+    return iterable
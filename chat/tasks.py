@@ -0,0 +1,257 @@
+"""Background tasks for work the sender should not wait for.
+
+``enqueue(func, *args)`` runs ``func(*args)`` on a pool of
+``CHAT_TASK_WORKERS`` threads once the caller's transaction commits. The
+queue holds at most ``CHAT_TASK_QUEUE_SIZE`` tasks; when it is full the
+caller runs the task itself, which slows producers down instead of
+dropping work. A failing task is retried ``CHAT_TASK_MAX_RETRIES`` times
+with exponential backoff. At exit the pool finishes every queued task
+first. ``CHAT_TASK_WORKERS = 0`` runs tasks inline, immediately. On an
+in-memory SQLite database, where a worker's writes would fail rather than
+wait for the lock, tasks run in the caller's thread right after its
+transaction commits.
+
+With ``CHAT_TASKS_DURABLE`` each task is instead stored as a
+``BackgroundTask`` row in the caller's transaction, so it survives a crash
+and commits or rolls back with the data it belongs to. The in-process
+workers (if any; none on in-memory SQLite) and ``manage.py run_chat_tasks``
+both work through those rows. Arguments must then be JSON-serializable and
+``func`` a module-level function.
+
+Tasks must be idempotent or fail without side effects: each run is wrapped
+in a transaction, and a retry starts over.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+_runner = None
+_runner_config = None
+_lock = threading.Lock()
+
+
+def task_path(func):
+    return f'{func.__module__}.{func.__qualname__}'
+
+
+def retry_delay(attempt):
+    """Seconds to wait before retry number ``attempt`` (1-based)"""
+    return getattr(settings, 'CHAT_TASK_RETRY_DELAY', 1.0) * 2 ** (attempt - 1)
+
+
+def max_retries():
+    return getattr(settings, 'CHAT_TASK_MAX_RETRIES', 3)
+
+
+def durable():
+    return getattr(settings, 'CHAT_TASKS_DURABLE', False)
+
+
+def run_task(func, args):
+    """Run one task in its own transaction, recording its outcome"""
+    name = func.__name__
+    started = time.perf_counter()
+    try:
+        with transaction.atomic():
+            func(*args)
+    except Exception:
+        metrics.TASK_RUNS.inc(task=name, outcome='error')
+        raise
+    finally:
+        metrics.TASK_SECONDS.observe(time.perf_counter() - started, task=name)
+    metrics.TASK_RUNS.inc(task=name, outcome='ok')
+
+
+def enqueue(func, *args):
+    """Run ``func(*args)`` in the background after the current transaction commits"""
+    if durable():
+        BackgroundTask.objects.create(func=task_path(func), args=list(args))
+        transaction.on_commit(wake)
+        return
+    runner = get_runner()
+    if runner is not None:
+        transaction.on_commit(lambda: runner.submit(func, args, time.time()))
+    elif getattr(settings, 'CHAT_TASK_WORKERS', 2):
+        # Workers are configured but cannot run on this database; the task
+        # still stays out of the caller's transaction
+        transaction.on_commit(lambda: run_inline(func, args))
+    else:
+        run_inline(func, args)
+
+
+def run_inline(func, args):
+    try:
+        run_task(func, args)
+    except Exception:
+        logger.exception('Background task %s failed', task_path(func))
+
+
+def wake():
+    runner = get_runner()
+    if runner is not None:
+        runner.wakeup.set()
+
+
+def get_runner():
+    """This process's task workers, or ``None`` when tasks run inline"""
+    global _runner, _runner_config
+    workers = getattr(settings, 'CHAT_TASK_WORKERS', 2)
+    if not workers or connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        # A shared-cache in-memory SQLite database (tests, benchmarks) fails a
+        # second connection's writes outright instead of waiting for the lock
+        return None
+    config = (workers, getattr(settings, 'CHAT_TASK_QUEUE_SIZE', 1000), durable())
+    with _lock:
+        if _runner is None or _runner_config != config:
+            if _runner is not None:
+                _runner.shutdown()
+            _runner = TaskRunner(*config)
+            _runner_config = config
+        return _runner
+
+
+def shutdown(timeout=None):
+    """Stop this process's workers once they have drained the queue"""
+    global _runner
+    with _lock:
+        runner, _runner = _runner, None
+    if runner is not None:
+        runner.shutdown(timeout)
+
+
+atexit.register(shutdown, 30)
+
+
+class TaskRunner:
+    """Worker threads fed from a bounded in-memory queue or the task table"""
+
+    def __init__(self, workers, queue_size, durable_mode):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.durable = durable_mode
+        self.wakeup = threading.Event()
+        self.closing = False
+        self.threads = [
+            threading.Thread(target=self.work, name=f'chat-task-{i}', daemon=True) for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, func, args, queued_at, attempt=0):
+        if self.closing:
+            self.execute(func, args, queued_at, attempt)
+            return
+        try:
+            self.queue.put_nowait((func, args, queued_at, attempt))
+        except queue.Full:
+            # Backpressure: the producer does the work itself
+            metrics.TASK_RUNS.inc(task=func.__name__, outcome='inline')
+            self.execute(func, args, queued_at, attempt)
+
+    def execute(self, func, args, queued_at, attempt):
+        metrics.TASK_QUEUE_WAIT.observe(max(0.0, time.time() - queued_at), task=func.__name__)
+        try:
+            run_task(func, args)
+        except Exception:
+            attempt += 1
+            if attempt > max_retries() or self.closing:
+                logger.exception('Background task %s failed', task_path(func))
+                return
+            timer = threading.Timer(retry_delay(attempt), self.submit, (func, args, time.time(), attempt))
+            timer.daemon = True
+            timer.start()
+
+    def work(self):
+        try:
+            if self.durable:
+                while not self.closing:
+                    close_old_connections()
+                    if not drain_due(limit=1):
+                        self.wakeup.wait(getattr(settings, 'CHAT_TASK_POLL_SECONDS', 1.0))
+                        self.wakeup.clear()
+                return
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                close_old_connections()
+                self.execute(*item)
+        finally:
+            close_old_connections()
+
+    def shutdown(self, timeout=None):
+        """Finish queued work, then stop; stored tasks stay for the next worker"""
+        self.closing = True
+        if self.durable:
+            self.wakeup.set()
+        else:
+            # Behind everything already queued, so the queue drains first
+            for _ in self.threads:
+                self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+def claim(limit):
+    """Lease up to ``limit`` due stored tasks to this worker"""
+    now = timezone.now()
+    lease = now + timedelta(seconds=getattr(settings, 'CHAT_TASK_LEASE_SECONDS', 300))
+    candidates = (
+        BackgroundTask.objects.filter(failed_at__isnull=True, run_after__lte=now)
+        .filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+        .order_by('run_after', 'id')
+        .values_list('id', 'locked_until')[:limit]
+    )
+    claimed = []
+    for task_id, locked_until in candidates:
+        # Conditional on the lease seen above, so only one worker wins a row
+        if BackgroundTask.objects.filter(id=task_id, locked_until=locked_until).update(locked_until=lease):
+            claimed.append(task_id)
+    return list(BackgroundTask.objects.filter(id__in=claimed).order_by('run_after', 'id'))
+
+
+def run_stored(stored):
+    """Run one claimed task; delete it on success, reschedule or fail it otherwise"""
+    queued_at = stored.run_after.timestamp()
+    try:
+        func = import_string(stored.func)
+        metrics.TASK_QUEUE_WAIT.observe(max(0.0, time.time() - queued_at), task=func.__name__)
+        run_task(func, stored.args)
+    except Exception:
+        attempts = stored.attempts + 1
+        values = {'attempts': attempts, 'locked_until': None, 'last_error': traceback.format_exc()}
+        if attempts > max_retries():
+            values['failed_at'] = timezone.now()
+        else:
+            values['run_after'] = timezone.now() + timedelta(seconds=retry_delay(attempts))
+        BackgroundTask.objects.filter(id=stored.id).update(**values)
+        return False
+    BackgroundTask.objects.filter(id=stored.id).delete()
+    return True
+
+
+def drain_due(limit=None):
+    """Run stored tasks that are due, up to ``limit``; returns how many ran"""
+    count = 0
+    while limit is None or count < limit:
+        batch = claim(100 if limit is None else min(100, limit - count))
+        if not batch:
+            break
+        for stored in batch:
+            run_stored(stored)
+        count += len(batch)
+    return count
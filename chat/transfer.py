@@ -0,0 +1,342 @@
+"""Streaming JSONL export and bulk import of conversations.
+
+An export is one JSON record per line::
+
+    {"type": "export", "version": 1, "exported_at": "..."}
+    {"type": "user", "id": 7, "username": "alice"}
+    {"type": "conversation", "id": 3, "participants": [7, 9], "created_at": "..."}
+    {"type": "conversation", "id": 4, "participants": [7, 9, 11], "created_at": "...",
+     "is_group": true, "name": "Hiking", "admins": [7]}
+    {"type": "message", "conversation": 3, "sender": 7, "content": "hi", "timestamp": "..."}
+
+All conversation records come before the message records, which are grouped
+by conversation in history order (archived messages first). A user record
+precedes the first record referring to it. Ids are only keys within the file:
+``import_stream`` matches users by username and gives every conversation and
+message a fresh id. An imported one-to-one conversation becomes the pair's
+direct conversation unless the pair already has one. Both directions run in constant memory apart from the
+user and conversation id maps.
+"""
+import json
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import pagecache
+from .archive import decode_segment
+from .models import GROUP_SUMMARY_MEMBERS, PREVIEW_LENGTH, ArchiveSegment, Conversation, Message, ReadState
+from .search import get_search_backend
+
+FORMAT_VERSION = 1
+CHUNK_SIZE = 2000
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def dump(record):
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def export_lines(conversation_ids=None, chunk_size=CHUNK_SIZE):
+    """Yield the export of ``conversation_ids`` (all conversations if ``None``) line by line.
+
+    Rows are read through ``iterator()``, i.e. server-side cursors on
+    PostgreSQL, so memory use does not grow with the history size.
+    """
+    conversations = Conversation.objects.order_by('id')
+    messages = Message.objects.order_by('conversation_id', 'seq')
+    if conversation_ids is not None:
+        conversations = conversations.filter(id__in=conversation_ids)
+        messages = messages.filter(conversation_id__in=conversation_ids)
+
+    yield dump({'type': 'export', 'version': FORMAT_VERSION, 'exported_at': timezone.now().isoformat()})
+
+    users = set()
+
+    def user_records(user_id, username):
+        if user_id not in users:
+            users.add(user_id)
+            yield dump({'type': 'user', 'id': user_id, 'username': username})
+
+    for conversation_id, created_at, participants, is_group, name in conversations.values_list(
+        'id', 'created_at', 'participant_summary', 'is_group', 'name'
+    ).iterator(chunk_size=chunk_size):
+        if is_group:
+            # A group's summary only previews its members
+            participants = [
+                {'id': user_id, 'username': username}
+                for user_id, username in Conversation.participants.through.objects.filter(
+                    conversation_id=conversation_id
+                ).order_by('user_id').values_list('user_id', 'user__username').iterator(chunk_size=chunk_size)
+            ]
+        for participant in participants:
+            yield from user_records(participant['id'], participant['username'])
+        record = {
+            'type': 'conversation',
+            'id': conversation_id,
+            'participants': [participant['id'] for participant in participants],
+            'created_at': created_at.isoformat(),
+        }
+        if is_group:
+            record.update(is_group=True, name=name, admins=sorted(
+                Conversation.admins.through.objects.filter(conversation_id=conversation_id)
+                .values_list('user_id', flat=True)
+            ))
+        yield dump(record)
+
+    # Archived senders are only known by username
+    archived_senders = {}
+    current = None
+    for conversation_id, sender_id, username, content, timestamp in messages.values_list(
+        'conversation_id', 'sender_id', 'sender__username', 'content', 'timestamp'
+    ).iterator(chunk_size=chunk_size):
+        if conversation_id != current:
+            # Archives always precede a conversation's remaining hot messages
+            current = conversation_id
+            yield from _archived_lines(conversation_id, archived_senders, user_records)
+        yield from user_records(sender_id, username)
+        yield dump({
+            'type': 'message',
+            'conversation': conversation_id,
+            'sender': sender_id,
+            'content': content,
+            'timestamp': timestamp.isoformat(),
+        })
+
+
+def _archived_lines(conversation_id, archived_senders, user_records):
+    segments = ArchiveSegment.objects.filter(conversation_id=conversation_id).order_by('last_timestamp', 'id')
+    for data in segments.values_list('data', flat=True).iterator():
+        messages = decode_segment(data)
+        unknown = {message['sender'] for message in messages} - archived_senders.keys()
+        if unknown:
+            archived_senders.update(User.objects.filter(username__in=unknown).values_list('username', 'id'))
+        for message in messages:
+            # A sender renamed since archiving keeps their archived name as key
+            sender = archived_senders.get(message['sender'], message['sender'])
+            yield from user_records(sender, message['sender'])
+            yield dump({
+                'type': 'message',
+                'conversation': conversation_id,
+                'sender': sender,
+                'content': message['content'],
+                'timestamp': message['timestamp'],
+            })
+
+
+def export_chunks(conversation_ids=None, chunk_size=CHUNK_SIZE):
+    """``export_lines`` joined into chunks of about 64 KiB, for streaming responses"""
+    buffer = []
+    size = 0
+    for line in export_lines(conversation_ids, chunk_size):
+        buffer.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+class Importer:
+    """Bulk loader for export records; feed lines to ``add`` and finish with ``close``.
+
+    Records are buffered and written with ``bulk_create`` in batches of
+    ``batch_size``, one transaction per batch. Imported history starts out
+    read by every participant.
+    """
+
+    def __init__(self, batch_size=CHUNK_SIZE):
+        self.batch_size = batch_size
+        self.user_ids = {}
+        self.conversation_ids = {}
+        self.usernames = {}
+        # Per imported conversation: [created_at, participant ids, message count, last message]
+        # (the ids are only kept for one-to-one chats; groups are read back from the table)
+        self.conversations = {}
+        self.pending_users = {}
+        self.pending_conversations = []
+        self.pending_messages = []
+        self.version_checked = False
+        self.counts = {'users': 0, 'conversations': 0, 'messages': 0}
+
+    def add(self, line):
+        line = line.strip()
+        if not line:
+            return
+        record = json.loads(line)
+        kind = record.get('type')
+        if not self.version_checked:
+            if kind != 'export' or record.get('version') != FORMAT_VERSION:
+                raise ValueError(f'Not a version {FORMAT_VERSION} chat export')
+            self.version_checked = True
+        elif kind == 'user':
+            self.pending_users[record['id']] = record['username']
+            if len(self.pending_users) >= self.batch_size:
+                self.flush_users()
+        elif kind == 'conversation':
+            self.pending_conversations.append(record)
+            if len(self.pending_conversations) >= self.batch_size:
+                self.flush_conversations()
+        elif kind == 'message':
+            self.pending_messages.append(record)
+            if len(self.pending_messages) >= self.batch_size:
+                self.flush_messages()
+        else:
+            raise ValueError(f'Unknown record type: {kind!r}')
+
+    def close(self):
+        self.flush_messages()
+        self.finish_conversations()
+        return self.counts
+
+    def flush_users(self):
+        if not self.pending_users:
+            return
+        pending, self.pending_users = self.pending_users, {}
+        existing = dict(User.objects.filter(username__in=pending.values()).values_list('username', 'id'))
+        missing = [username for username in dict.fromkeys(pending.values()) if username not in existing]
+        # Imported accounts cannot log in until a password is set
+        created = User.objects.bulk_create(
+            [User(username=username, password=make_password(None)) for username in missing]
+        )
+        existing.update((user.username, user.id) for user in created)
+        for key, username in pending.items():
+            self.user_ids[key] = existing[username]
+            self.usernames[existing[username]] = username
+        self.counts['users'] += len(created)
+
+    def flush_conversations(self):
+        self.flush_users()
+        if not self.pending_conversations:
+            return
+        pending, self.pending_conversations = self.pending_conversations, []
+        conversations = []
+        members = []
+        admins = []
+        for record in pending:
+            participant_ids = sorted({self.user_ids[key] for key in record['participants']})
+            is_group = bool(record.get('is_group'))
+            members.append(participant_ids)
+            admins.append({self.user_ids[key] for key in record.get('admins', ())})
+            conversations.append(Conversation(
+                is_group=is_group,
+                name=record.get('name', '') if is_group else '',
+                member_count=len(participant_ids),
+                participant_summary=[
+                    {'id': user_id, 'username': self.usernames[user_id]}
+                    for user_id in (participant_ids[:GROUP_SUMMARY_MEMBERS] if is_group else participant_ids)
+                ],
+                direct_key=(
+                    Conversation.direct_key_for(*participant_ids)
+                    if len(participant_ids) == 2 and not is_group else None
+                ),
+            ))
+        with transaction.atomic():
+            # A pair that already has a direct conversation keeps it; the
+            # imported one stays a separate, unkeyed conversation
+            keys = {conversation.direct_key for conversation in conversations} - {None}
+            taken = set(Conversation.objects.filter(direct_key__in=keys).values_list('direct_key', flat=True))
+            for conversation in conversations:
+                if conversation.direct_key in taken:
+                    conversation.direct_key = None
+                elif conversation.direct_key is not None:
+                    taken.add(conversation.direct_key)
+            created = Conversation.objects.bulk_create(conversations)
+            # Bypasses the m2m_changed handler, which would notify sockets
+            # and create read states one conversation at a time
+            Conversation.participants.through.objects.bulk_create([
+                Conversation.participants.through(conversation_id=conversation.id, user_id=user_id)
+                for conversation, participant_ids in zip(created, members)
+                for user_id in participant_ids
+            ], batch_size=self.batch_size)
+            Conversation.admins.through.objects.bulk_create([
+                Conversation.admins.through(conversation_id=conversation.id, user_id=user_id)
+                for conversation, admin_ids in zip(created, admins)
+                for user_id in sorted(admin_ids)
+            ])
+        pagecache.bump_users({user_id for participant_ids in members for user_id in participant_ids})
+        for record, conversation, participant_ids in zip(pending, created, members):
+            self.conversation_ids[record['id']] = conversation.id
+            self.conversations[conversation.id] = [
+                parse_datetime(record['created_at']),
+                None if conversation.is_group else participant_ids,
+                0,
+                None,
+            ]
+        self.counts['conversations'] += len(created)
+
+    def flush_messages(self):
+        self.flush_conversations()
+        if not self.pending_messages:
+            return
+        pending, self.pending_messages = self.pending_messages, []
+        to_create = []
+        for record in pending:
+            conversation_id = self.conversation_ids[record['conversation']]
+            state = self.conversations[conversation_id]
+            state[2] += 1
+            to_create.append(Message(
+                conversation_id=conversation_id,
+                sender_id=self.user_ids[record['sender']],
+                content=record['content'],
+                timestamp=parse_datetime(record['timestamp']),
+                seq=state[2],
+            ))
+        with transaction.atomic():
+            created = Message.objects.bulk_create(to_create)
+            get_search_backend().index_messages(created)
+        for message in created:
+            self.conversations[message.conversation_id][3] = message
+        self.counts['messages'] += len(created)
+
+    def finish_conversations(self):
+        """Fill in the denormalized summaries and read states of the new conversations"""
+        self.flush_conversations()
+        items = list(self.conversations.items())
+        self.conversations = {}
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            conversations = []
+            read_states = []
+            for conversation_id, (created_at, participants, count, last) in batch:
+                if participants is None:
+                    participants = Conversation.participants.through.objects.filter(
+                        conversation_id=conversation_id
+                    ).values_list('user_id', flat=True)
+                conversation = Conversation(
+                    id=conversation_id, created_at=created_at, updated_at=created_at, last_seq=count
+                )
+                if last is not None:
+                    conversation.updated_at = last.timestamp
+                    conversation.last_message_id = last.id
+                    conversation.last_message_preview = last.content[:PREVIEW_LENGTH]
+                    conversation.last_message_at = last.timestamp
+                    conversation.last_message_sender = self.usernames[last.sender_id]
+                conversations.append(conversation)
+                read_states.extend(
+                    ReadState(
+                        conversation_id=conversation_id,
+                        user_id=user_id,
+                        last_read_message_id=conversation.last_message_id or 0,
+                    )
+                    for user_id in participants
+                )
+            with transaction.atomic():
+                Conversation.objects.bulk_update(conversations, [
+                    'created_at', 'updated_at', 'last_seq', 'last_message', 'last_message_preview',
+                    'last_message_at', 'last_message_sender',
+                ])
+                ReadState.objects.bulk_create(read_states, ignore_conflicts=True)
+                pagecache.bump_conversations([conversation.id for conversation in conversations])
+
+
+def import_stream(lines, batch_size=CHUNK_SIZE):
+    """Import an export from an iterable of lines; returns counts of created rows"""
+    importer = Importer(batch_size)
+    for line in lines:
+        importer.add(line)
+    return importer.close()
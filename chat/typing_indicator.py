@@ -0,0 +1,161 @@
+import asyncio
+import weakref
+
+from django.conf import settings
+
+from .fanout import send_to_conversation
+from .wire import frame_event
+
+
+class TypingState:
+    __slots__ = (
+        'username', 'shards', 'is_typing', 'broadcast_state', 'last_broadcast',
+        'expire_handle', 'flush_handle',
+    )
+
+    def __init__(self, username, shards):
+        self.username = username
+        self.shards = shards
+        self.is_typing = False
+        self.broadcast_state = False
+        self.last_broadcast = float('-inf')
+        self.expire_handle = None
+        self.flush_handle = None
+
+
+class TypingTracker:
+    """Typing state per (conversation, user), broadcast only on transitions.
+
+    Repeated ``typing`` frames just refresh a TTL. A state change is
+    broadcast at most once per ``window`` seconds; flips that cancel each
+    other out inside the window are never published, and a state nobody
+    refreshed for ``ttl`` seconds expires to "not typing" on its own.
+    """
+
+    def __init__(self, channel_layer, ttl, window):
+        self.channel_layer = channel_layer
+        self.ttl = ttl
+        self.window = window
+        self.states = {}
+        self.tasks = set()
+
+    async def update(self, conversation_id, user_id, username, is_typing, shards=1):
+        """Record a typing frame; ``shards`` is the conversation's fan-out shard count"""
+        key = (conversation_id, user_id)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = TypingState(username, shards)
+        state.is_typing = is_typing
+
+        if state.expire_handle is not None:
+            state.expire_handle.cancel()
+            state.expire_handle = None
+        if is_typing:
+            state.expire_handle = asyncio.get_running_loop().call_later(
+                self.ttl, self._expire, key
+            )
+        await self._publish(key, state)
+
+    def clear(self, conversation_id, user_id):
+        """Forget a typing state without broadcasting.
+
+        Used when the user sends a message: clients hide that user's
+        indicator when the message arrives.
+        """
+        state = self.states.pop((conversation_id, user_id), None)
+        if state is not None:
+            self._cancel(state)
+
+    async def stop(self, conversation_ids, user_id):
+        """Publish "stopped typing" for a user whose socket is going away"""
+        for conversation_id in conversation_ids:
+            state = self.states.pop((conversation_id, user_id), None)
+            if state is None:
+                continue
+            self._cancel(state)
+            if state.broadcast_state:
+                state.is_typing = False
+                await self._broadcast((conversation_id, user_id), state)
+
+    async def _publish(self, key, state):
+        if state.is_typing == state.broadcast_state:
+            # Nothing changed from the clients' point of view
+            if state.flush_handle is not None:
+                state.flush_handle.cancel()
+                state.flush_handle = None
+            return
+
+        loop = asyncio.get_running_loop()
+        delay = state.last_broadcast + self.window - loop.time()
+        if delay <= 0:
+            await self._broadcast(key, state)
+        elif state.flush_handle is None:
+            state.flush_handle = loop.call_later(delay, lambda: self._spawn(self._flush(key)))
+
+    async def _flush(self, key):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.flush_handle = None
+        if state.is_typing != state.broadcast_state:
+            await self._broadcast(key, state)
+
+    async def _broadcast(self, key, state):
+        conversation_id, user_id = key
+        loop = asyncio.get_running_loop()
+        state.broadcast_state = state.is_typing
+        state.last_broadcast = loop.time()
+        if not state.is_typing:
+            # Keep the state around for one window so the rate limit holds
+            loop.call_later(self.window, self._discard_if_idle, key, state)
+        await send_to_conversation(
+            self.channel_layer,
+            conversation_id,
+            state.shards,
+            frame_event('typing_status', {
+                'type': 'typing_status',
+                'conversation_id': conversation_id,
+                'username': state.username,
+                'is_typing': state.is_typing
+            })
+        )
+
+    def _expire(self, key):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.expire_handle = None
+        state.is_typing = False
+        self._spawn(self._publish(key, state))
+
+    def _discard_if_idle(self, key, state):
+        if self.states.get(key) is state and not state.is_typing and state.flush_handle is None:
+            del self.states[key]
+
+    def _cancel(self, state):
+        for handle in (state.expire_handle, state.flush_handle):
+            if handle is not None:
+                handle.cancel()
+        state.expire_handle = state.flush_handle = None
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+def get_typing_tracker(channel_layer):
+    """Return the typing tracker bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = TypingTracker(
+            channel_layer,
+            ttl=getattr(settings, 'CHAT_TYPING_TTL_SECONDS', 6),
+            window=getattr(settings, 'CHAT_TYPING_WINDOW_MS', 1000) / 1000,
+        )
+        _trackers[loop] = tracker
+    return tracker
@@ -9,5 +9,28 @@ urlpatterns = [
     path('start-conversation/', views.start_conversation, name='start_conversation'),
     path('api/conversations/', views.get_conversations, name='get_conversations'),
     path('api/chat/<int:conversation_id>/', views.chat_room_content, name='chat_room_content'),
+    path('api/chat/<int:conversation_id>/messages/', views.message_history, name='message_history'),
+    path('api/chat/<int:conversation_id>/export/', views.export_conversation, name='export_conversation'),
+    path('api/chat/<int:conversation_id>/members/', views.group_members, name='group_members'),
+    path(
+        'api/chat/<int:conversation_id>/members/<int:user_id>/remove/',
+        views.remove_group_member, name='remove_group_member'
+    ),
+    path(
+        'api/chat/<int:conversation_id>/members/<int:user_id>/admin/',
+        views.set_group_admin, name='set_group_admin'
+    ),
+    path('api/groups/', views.create_group, name='create_group'),
+    path('api/uploads/', views.create_upload, name='create_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('api/attachments/<uuid:attachment_id>/', views.download_attachment, name='download_attachment'),
+    path(
+        'api/attachments/<uuid:attachment_id>/thumbnail/',
+        views.attachment_thumbnail, name='attachment_thumbnail'
+    ),
     path('api/messages/mark-as-read/', views.mark_messages_as_read, name='mark_messages_as_read'),
+    path('api/search/', views.search_messages, name='search_messages'),
+    path('api/users/', views.user_search, name='user_search'),
+    path('api/presence/', views.presence_status, name='presence_status'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
@@ -1,11 +1,31 @@
 import json
+import os
+import re
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib import messages
-from django.http import JsonResponse
-from .models import Conversation, Message
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.views.decorators.http import condition
+from . import media, metrics, pagecache
+from .consumers import unread_event
+from .directory import search_users
+from .groups import conversation_group, user_group
+from .history import fetch_history
+from .metrics import timed_group_send
+from .models import Attachment, Conversation, ReadState
+from .presence import fetch_statuses
+from .search import get_search_backend
+from .streaming import response_body
+from .transfer import export_chunks
+from .wire import frame_event
+
+PRESENCE_MAX_USERS = 500
+CONTENT_TYPE_RE = re.compile(r'^[\w.+-]+/[\w.+-]+$')
 
 
 def login_view(request):
@@ -44,11 +64,11 @@ def register_view(request):
 @login_required
 def chat_list(request):
     conversations = Conversation.objects.filter(participants=request.user).order_by('-updated_at')
-    # Get all users to start conversations with, excluding the current user
-    users = User.objects.exclude(id=request.user.id)
+    for conversation in conversations:
+        conversation.display_name = conversation.get_display_name(request.user)
+    # The "new chat" picker looks users up through /api/users/ as you type
     return render(request, 'chat/chat_list.html', {
         'conversations': conversations,
-        'users': users,
         'current_user': request.user
     })
 
@@ -58,34 +78,65 @@ def start_conversation(request):
     if request.method == 'POST':
         user_id = request.POST.get('user_id')
         other_user = get_object_or_404(User, id=user_id)
-        
-        # Check if conversation already exists
-        existing_conversation = Conversation.objects.filter(
-            participants=request.user
-        ).filter(participants=other_user).first()
-        
-        if existing_conversation:
-            return redirect(f'/?chat={existing_conversation.id}')
-        
-        # Create new conversation
-        conversation = Conversation.objects.create()
-        conversation.participants.add(request.user, other_user)
-        
+
+        # One indexed lookup; creates the conversation if the pair has none
+        conversation, _ = Conversation.get_or_create_direct(request.user, other_user)
+
         return redirect(f'/?chat={conversation.id}')
     
     return redirect('chat_list')
 
 
+def room_etag(request, conversation_id):
+    return pagecache.page_etag(request, pagecache.room_page(conversation_id, request.user.id))
+
+
 @login_required
+@condition(etag_func=room_etag)
 def chat_room_content(request, conversation_id):
+    # A cached fragment was built after this user's membership check, and any
+    # membership change invalidates it: a hit needs no queries at all
+    page = request.cached_page
+    if page is None:
+        versions = pagecache.current_versions([pagecache.room_key(conversation_id)])
+        conversation = get_object_or_404(Conversation, id=conversation_id)
+        if not conversation.participants.filter(id=request.user.id).exists():
+            return JsonResponse({'error': 'Not a participant'}, status=403)
+
+        content = render_to_string('chat/_chat_room_content.html', {
+            'conversation': conversation,
+            'display_name': conversation.get_display_name(request.user),
+            'current_user': request.user
+        }, request)
+        page = pagecache.store_page(
+            pagecache.room_page(conversation_id, request.user.id), versions, content, 'text/html; charset=utf-8'
+        )
+    return pagecache.page_response(page)
+
+
+@login_required
+def message_history(request, conversation_id):
     conversation = get_object_or_404(Conversation, id=conversation_id)
     if not conversation.participants.filter(id=request.user.id).exists():
         return JsonResponse({'error': 'Not a participant'}, status=403)
-    
-    return render(request, 'chat/_chat_room_content.html', {
-        'conversation': conversation,
-        'current_user': request.user
-    })
+
+    try:
+        before_id = request.GET.get('before_id')
+        before_id = int(before_id) if before_id else None
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+
+    messages_page, has_more = fetch_history(conversation.id, before_id=before_id, limit=limit)
+    data = {
+        'messages': messages_page,
+        'has_more': has_more,
+        'next_before_id': messages_page[0]['id'] if messages_page and has_more else None,
+    }
+    if before_id is None:
+        data['read_up_to'] = ReadState.watermarks(conversation.id)
+    return JsonResponse(data)
 
 
 @login_required
@@ -93,59 +144,393 @@ def mark_messages_as_read(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            message_ids = data.get('message_ids', [])
             conversation_id = data.get('conversation_id')
+            message_id = data.get('message_id')
+            if message_id is None and data.get('message_ids'):
+                # Older clients send every id; the newest one is the watermark
+                message_id = max(int(i) for i in data['message_ids'])
 
-            if not conversation_id or not message_ids:
+            if not conversation_id or not message_id:
                 return JsonResponse({'error': 'Missing data'}, status=400)
+            conversation_id = int(conversation_id)
+            message_id = int(message_id)
+
+            # Move the read watermark
+            updated = ReadState.mark_read(conversation_id, request.user.id, message_id)
 
-            # Update messages
-            messages_to_update = Message.objects.filter(
-                id__in=message_ids,
-                conversation_id=conversation_id,
-                is_read=False
-            ).exclude(sender=request.user)
-            
-            updated_count = messages_to_update.update(is_read=True)
-
-            # Notify via WebSocket
-            if updated_count > 0:
-                from channels.layers import get_channel_layer
-                from asgiref.sync import async_to_sync
-                channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(
-                    f'chat_{conversation_id}',
-                    {
-                        'type': 'messages_read',
-                        'sender_username': request.user.username,
-                        'message_ids': message_ids
-                    }
+            from channels.layers import get_channel_layer
+            from asgiref.sync import async_to_sync
+            channel_layer = get_channel_layer()
+            if updated:
+                # The user's sockets update the unread count in their lists
+                async_to_sync(timed_group_send)(
+                    channel_layer,
+                    user_group(request.user.id),
+                    unread_event(conversation_id, ReadState.unread_for(conversation_id, request.user.id))
                 )
 
-            return JsonResponse({'status': 'success', 'updated_count': updated_count})
-        except json.JSONDecodeError:
+            # Notify via WebSocket; group reads are not broadcast
+            if updated and not Conversation.objects.filter(id=conversation_id, is_group=True).exists():
+                async_to_sync(timed_group_send)(
+                    channel_layer,
+                    conversation_group(conversation_id),
+                    frame_event('read_up_to', {
+                        'type': 'read_up_to',
+                        'conversation_id': conversation_id,
+                        'username': request.user.username,
+                        'message_id': message_id
+                    })
+                )
+
+            return JsonResponse({'status': 'success', 'updated': updated})
+        except (json.JSONDecodeError, TypeError, ValueError):
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
 
 @login_required
+def export_conversation(request, conversation_id):
+    """Stream a conversation's whole history, archive included, as JSONL"""
+    conversation = get_object_or_404(Conversation, id=conversation_id)
+    if not conversation.participants.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Not a participant'}, status=403)
+
+    response = StreamingHttpResponse(
+        response_body(request, export_chunks([conversation.id])), content_type='application/x-ndjson'
+    )
+    response['Content-Disposition'] = f'attachment; filename="conversation-{conversation.id}.jsonl"'
+    return response
+
+
+def conversations_etag(request):
+    return pagecache.page_etag(request, pagecache.conversation_list_page(request.user.id))
+
+
+@login_required
+@condition(etag_func=conversations_etag)
 def get_conversations(request):
-    conversations = Conversation.objects.filter(participants=request.user).order_by('-updated_at')
-    data = []
-    for conv in conversations:
-        last_message = conv.get_last_message()
-        
-        # Get the other participant for display
-        other_participants = [p.username for p in conv.participants.all() if p != request.user]
-        display_name = conv.get_display_name(request.user)
-        avatar_initial = display_name[0].upper() if display_name else '?'
-        
-        data.append({
-            'id': conv.id,
-            'name': display_name,
-            'avatar_initial': avatar_initial,
-            'last_message': last_message.content if last_message else '',
-            'last_message_time': last_message.timestamp.isoformat() if last_message else '',
-            'participants': other_participants
-        })
-    return JsonResponse({'conversations': data})
+    page = request.cached_page
+    if page is None:
+        # Versions are read before the data they describe, so a write racing
+        # with this request leaves a page that is already stale, never one
+        # that looks current
+        versions = pagecache.current_versions([pagecache.user_key(request.user.id)])
+        conversation_ids = Conversation.participants.through.objects.filter(
+            user=request.user
+        ).values_list('conversation_id', flat=True)
+        versions.update(pagecache.current_versions(
+            [pagecache.conversation_key(conversation_id) for conversation_id in conversation_ids]
+        ))
+
+        # Served entirely from the denormalized summary: one query regardless
+        # of how many conversations the user has.
+        conversations = (
+            Conversation.objects.filter(participants=request.user)
+            .annotate(unread_count=ReadState.unread_count_subquery(request.user))
+            .order_by('-updated_at')
+        )
+        data = [conv.to_summary_dict(request.user) for conv in conversations]
+        page = pagecache.store_page(
+            pagecache.conversation_list_page(request.user.id),
+            versions,
+            json.dumps({'conversations': data}, cls=DjangoJSONEncoder),
+            'application/json',
+        )
+    return pagecache.page_response(page)
+
+
+@login_required
+def search_messages(request):
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'Missing query'}, status=400)
+
+    try:
+        conversation_id = request.GET.get('conversation_id')
+        conversation_id = int(conversation_id) if conversation_id else None
+        offset = int(request.GET.get('offset') or 0)
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+
+    # Ranked matches, restricted to the user's own conversations
+    results, has_more = get_search_backend().search(
+        request.user, query, conversation_id=conversation_id, offset=offset, limit=limit
+    )
+    return JsonResponse({
+        'results': results,
+        'has_more': has_more,
+        'next_offset': max(offset, 0) + len(results) if has_more else None,
+    })
+
+
+@login_required
+def user_search(request):
+    """Username autocomplete: one page of users whose name starts with ``q``"""
+    try:
+        offset = int(request.GET.get('offset') or 0)
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+
+    users, has_more = search_users(request.GET.get('q', '').strip(), offset=offset, limit=limit)
+    return JsonResponse({
+        # Pages are shared by everyone, so the requester is dropped here
+        'users': [user for user in users if user['id'] != request.user.id],
+        'has_more': has_more,
+        'next_offset': max(offset, 0) + len(users) if has_more else None,
+    })
+
+
+@login_required
+def presence_status(request):
+    """Online status and last-seen time for many users in one request"""
+    try:
+        user_ids = [int(i) for i in request.GET.get('user_ids', '').split(',') if i.strip()]
+    except ValueError:
+        return JsonResponse({'error': 'Invalid user ids'}, status=400)
+    if len(user_ids) > PRESENCE_MAX_USERS:
+        return JsonResponse({'error': f'At most {PRESENCE_MAX_USERS} user ids'}, status=400)
+
+    # Only people the user shares a one-to-one conversation with are visible
+    visible = set(
+        Conversation.participants.through.objects.filter(
+            conversation__participants=request.user, conversation__is_group=False, user_id__in=user_ids
+        ).values_list('user_id', flat=True)
+    )
+    statuses = fetch_statuses(sorted(visible)) if visible else {}
+    return JsonResponse({'users': {
+        str(user_id): {
+            'online': status['online'],
+            'last_seen': status['last_seen'].isoformat() if status['last_seen'] else None,
+        }
+        for user_id, status in statuses.items()
+    }})
+
+
+def parse_user_ids(request):
+    """The ``user_ids`` list of a JSON request body"""
+    data = json.loads(request.body or '{}')
+    return [int(user_id) for user_id in data.get('user_ids', [])], data
+
+
+@login_required
+def create_group(request):
+    """Create a group from ``{"name", "user_ids"}``; the creator becomes its admin"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    try:
+        user_ids, data = parse_user_ids(request)
+        name = str(data.get('name', '')).strip()
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not name or len(name) > 100:
+        return JsonResponse({'error': 'A group name of 1 to 100 characters is required'}, status=400)
+
+    members = User.objects.filter(id__in=user_ids, is_active=True).values_list('id', flat=True)
+    conversation = Conversation.create_group(name, request.user, members)
+    conversation.refresh_from_db(fields=['member_count'])
+    return JsonResponse({
+        'id': conversation.id,
+        'name': conversation.name,
+        'member_count': conversation.member_count,
+    }, status=201)
+
+
+@login_required
+def group_members(request, conversation_id):
+    """GET: one page of members by user id. POST: add ``user_ids`` (admins only)"""
+    conversation = get_object_or_404(Conversation, id=conversation_id)
+    if not conversation.participants.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Not a participant'}, status=403)
+
+    if request.method == 'POST':
+        if not conversation.is_group or not conversation.is_admin(request.user):
+            return JsonResponse({'error': 'Only group admins can add members'}, status=403)
+        try:
+            user_ids, _ = parse_user_ids(request)
+        except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        conversation.participants.add(
+            *User.objects.filter(id__in=user_ids, is_active=True).values_list('id', flat=True)
+        )
+        conversation.refresh_from_db(fields=['member_count'])
+        return JsonResponse({'member_count': conversation.member_count})
+
+    try:
+        after_id = int(request.GET.get('after_id') or 0)
+        limit = request.GET.get('limit')
+        limit = int(limit) if limit else getattr(settings, 'CHAT_MEMBERS_PAGE_SIZE', 100)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid pagination parameters'}, status=400)
+    limit = max(1, min(limit, getattr(settings, 'CHAT_MEMBERS_MAX_PAGE_SIZE', 500)))
+
+    members, has_more = conversation.members_page(after_id, limit)
+    return JsonResponse({
+        'members': members,
+        'member_count': conversation.member_count,
+        'has_more': has_more,
+        'next_after_id': members[-1]['id'] if has_more else None,
+    })
+
+
+@login_required
+def remove_group_member(request, conversation_id, user_id):
+    """Remove a member (admins) or leave the group (anyone, for themselves)"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    conversation = get_object_or_404(Conversation, id=conversation_id, is_group=True)
+    if not conversation.participants.filter(id=request.user.id).exists():
+        return JsonResponse({'error': 'Not a participant'}, status=403)
+    if user_id != request.user.id and not conversation.is_admin(request.user):
+        return JsonResponse({'error': 'Only group admins can remove members'}, status=403)
+    conversation.remove_member(user_id)
+    return JsonResponse({'status': 'success'})
+
+
+@login_required
+def set_group_admin(request, conversation_id, user_id):
+    """Grant or revoke a member's admin role from ``{"is_admin": bool}`` (admins only)"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    conversation = get_object_or_404(Conversation, id=conversation_id, is_group=True)
+    if not conversation.is_admin(request.user):
+        return JsonResponse({'error': 'Only group admins can change roles'}, status=403)
+    if not conversation.participants.filter(id=user_id).exists():
+        return JsonResponse({'error': 'Not a member'}, status=404)
+    try:
+        is_admin = bool(json.loads(request.body or '{}')['is_admin'])
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+
+    if is_admin:
+        conversation.admins.add(user_id)
+    elif conversation.admins.exclude(id=user_id).exists():
+        conversation.admins.remove(user_id)
+    else:
+        return JsonResponse({'error': 'A group needs at least one admin'}, status=400)
+    return JsonResponse({'status': 'success'})
+
+
+def is_participant(user, conversation_id):
+    return Conversation.participants.through.objects.filter(
+        conversation_id=conversation_id, user_id=user.id
+    ).exists()
+
+
+def upload_state(attachment):
+    data = {
+        'id': str(attachment.id),
+        'offset': attachment.received,
+        'size': attachment.size,
+        'complete': attachment.complete,
+    }
+    if attachment.complete:
+        data['attachment'] = attachment.to_ref()
+    return data
+
+
+@login_required
+def create_upload(request):
+    """Start a chunked upload from ``{"conversation_id", "filename", "size", "content_type"}``"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    try:
+        data = json.loads(request.body or '{}')
+        conversation_id = int(data['conversation_id'])
+        filename = os.path.basename(str(data['filename'])).strip()[:255]
+        size = int(data['size'])
+        content_type = str(data.get('content_type') or '').lower()
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not filename or size < 0:
+        return JsonResponse({'error': 'A file name and size are required'}, status=400)
+    if size > getattr(settings, 'CHAT_ATTACHMENT_MAX_BYTES', 100 * 1024 * 1024):
+        return JsonResponse({'error': 'File too large'}, status=413)
+    if len(content_type) > 100 or not CONTENT_TYPE_RE.match(content_type):
+        content_type = 'application/octet-stream'
+    if not is_participant(request.user, conversation_id):
+        return JsonResponse({'error': 'Not a participant'}, status=403)
+
+    attachment = Attachment.objects.create(
+        owner=request.user,
+        conversation_id=conversation_id,
+        filename=filename,
+        content_type=content_type,
+        size=size,
+    )
+    if size == 0:
+        media.complete(attachment)
+    return JsonResponse(upload_state(attachment), status=201)
+
+
+@login_required
+def upload_chunk(request, upload_id):
+    """GET: the offset to resume from. PUT: the chunk starting at ``Upload-Offset``"""
+    attachment = get_object_or_404(Attachment, id=upload_id, owner=request.user)
+    if request.method == 'GET':
+        return JsonResponse(upload_state(attachment))
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    if attachment.complete:
+        return JsonResponse({'error': 'Upload already complete', **upload_state(attachment)}, status=409)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.headers.get('Content-Length') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Upload-Offset and Content-Length headers are required'}, status=400)
+    if length > getattr(settings, 'CHAT_UPLOAD_CHUNK_MAX_BYTES', 8 * 1024 * 1024):
+        return JsonResponse({'error': 'Chunk too large'}, status=413)
+
+    # The body is read from the request stream block by block
+    try:
+        media.append_chunk(attachment, offset, request, length)
+    except media.OffsetMismatch as e:
+        return JsonResponse({'error': 'Offset mismatch', 'offset': e.offset}, status=409)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(upload_state(attachment))
+
+
+def get_download(request, attachment_id):
+    """A complete attachment the user may download, or an error response"""
+    attachment = get_object_or_404(
+        Attachment.objects.select_related('media'), id=attachment_id, media__isnull=False
+    )
+    if not is_participant(request.user, attachment.conversation_id):
+        return None, JsonResponse({'error': 'Not a participant'}, status=403)
+    return attachment, None
+
+
+@login_required
+def download_attachment(request, attachment_id):
+    attachment, error = get_download(request, attachment_id)
+    if error:
+        return error
+    stored = attachment.media
+    return media.serve_file(request, stored.file.name, stored.size, attachment.content_type, attachment.filename)
+
+
+@login_required
+def attachment_thumbnail(request, attachment_id):
+    attachment, error = get_download(request, attachment_id)
+    if error:
+        return error
+    name = attachment.media.thumbnail.name
+    if not name:
+        return JsonResponse({'error': 'No thumbnail'}, status=404)
+    filename = f'{os.path.splitext(attachment.filename)[0]}.jpg'
+    return media.serve_file(request, name, os.path.getsize(media.media_path(name)), 'image/jpeg', filename)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for this worker process"""
+    if not metrics.metrics_enabled():
+        raise Http404
+    if not metrics.scrape_allowed(request):
+        response = HttpResponse('Authentication required\n', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,53 @@
+import json
+import time
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack ships with channels-redis
+    msgpack = None
+
+
+JSON_SUBPROTOCOL = 'chat.json'
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+
+def msgpack_enabled():
+    return msgpack is not None and getattr(settings, 'CHAT_MSGPACK_ENABLED', True)
+
+
+def negotiate_subprotocol(requested):
+    """Pick the wire format for a socket from the client's offered subprotocols"""
+    if MSGPACK_SUBPROTOCOL in requested and msgpack_enabled():
+        return MSGPACK_SUBPROTOCOL
+    if JSON_SUBPROTOCOL in requested:
+        return JSON_SUBPROTOCOL
+    return None
+
+
+def encode_frame(frame):
+    """Serialize an outbound frame once for every wire format in use"""
+    encoded = {'text': json.dumps(frame)}
+    if msgpack_enabled():
+        encoded['bytes'] = msgpack.packb(frame)
+    return encoded
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        if msgpack is None:
+            raise ValueError('Binary frames are not supported')
+        return msgpack.unpackb(bytes_data)
+    return json.loads(text_data)
+
+
+def frame_event(handler, frame, **extra):
+    """Channel-layer event carrying ``frame`` pre-encoded for fan-out.
+
+    Every recipient forwards the encoded payload as-is, so a group send
+    costs one serialization instead of one per member. ``extra`` holds the
+    few fields consumers themselves need to look at. ``sent_at`` lets each
+    recipient tell how far behind it is.
+    """
+    return {'type': handler, 'frame': encode_frame(frame), 'sent_at': time.time(), **extra}
@@ -17,14 +17,23 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatsapp_clone.settings')
 django_asgi_app = get_asgi_application()
 
 from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
+from django.conf import settings
 import chat.routing
+from chat.fanout import FanoutConsumer
 
-application = ProtocolTypeRouter({
+protocols = {
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
         )
     ),
-})
+}
+if settings.CHAT_FANOUT_CHANNEL:
+    # Served by `manage.py runworker <CHAT_FANOUT_CHANNEL>` processes
+    protocols["channel"] = ChannelNameRouter({
+        settings.CHAT_FANOUT_CHANNEL: FanoutConsumer.as_asgi(),
+    })
+
+application = ProtocolTypeRouter(protocols)
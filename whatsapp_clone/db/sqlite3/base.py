@@ -0,0 +1,36 @@
+"""SQLite backend honouring the ``init_command`` and ``transaction_mode`` options.
+
+Django 5.1 supports both options natively; this wrapper backports them to
+Django 4.2 so the SQLite profile can set pragmas on every new connection
+and open write transactions with ``BEGIN IMMEDIATE``.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = {'DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop('init_command', None)
+        mode = params.pop('transaction_mode', None)
+        if mode is not None and mode.upper() not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"settings.DATABASES['{self.alias}']['OPTIONS']['transaction_mode'] "
+                f"must be one of {', '.join(sorted(TRANSACTION_MODES))}"
+            )
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        init_command = self.settings_dict['OPTIONS'].get('init_command')
+        if init_command:
+            for statement in init_command.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict['OPTIONS'].get('transaction_mode')
+        self.cursor().execute(f'BEGIN {mode.upper()}' if mode else 'BEGIN')
@@ -6,6 +6,8 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 
+from whatsapp_clone.db import parse_database_url, sqlite_database
+
 load_dotenv()
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # For static files in production
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -89,16 +92,24 @@ ASGI_APPLICATION = 'whatsapp_clone.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+# Persistent connections: each database_sync_to_async thread keeps its
+# connection for DB_CONN_MAX_AGE seconds instead of reconnecting per call
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '600'))
+
+# DATABASE_URL (postgres://... or sqlite:///...) overrides the default tuned
+# SQLite profile (WAL, synchronous=NORMAL, busy_timeout, BEGIN IMMEDIATE)
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+if DATABASE_URL:
+    DATABASES = {'default': parse_database_url(DATABASE_URL, conn_max_age=DB_CONN_MAX_AGE)}
+else:
+    DATABASES = {'default': sqlite_database(BASE_DIR / 'db.sqlite3', conn_max_age=DB_CONN_MAX_AGE)}
 
 # Channels configuration
 # Use Redis for production (Render) and in-memory for development
 REDIS_URL = os.environ.get('REDIS_URL')
+# Events a socket's channel may hold before the layer drops new ones
+CHANNEL_CAPACITY = int(os.environ.get('CHANNEL_CAPACITY', '200'))
 
 if REDIS_URL:
     # Production configuration with Redis
@@ -107,6 +118,7 @@ if REDIS_URL:
             'BACKEND': 'channels_redis.core.RedisChannelLayer',
             'CONFIG': {
                 "hosts": [REDIS_URL],
+                "capacity": CHANNEL_CAPACITY,
             },
         },
     }
@@ -115,6 +127,9 @@ else:
     CHANNEL_LAYERS = {
         'default': {
             'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': CHANNEL_CAPACITY,
+            },
         },
     }
 
@@ -174,3 +189,146 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/login/'
+
+# Chat
+# Page size used for message history (initial load and "load older messages")
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+# Reconnecting clients get at most this many missed messages as a delta;
+# beyond that they are told to refetch their history instead
+CHAT_SYNC_MAX_DELTA = 200
+
+# Group commit: buffer incoming messages for up to CHAT_GROUP_COMMIT_WINDOW_MS
+# (or CHAT_GROUP_COMMIT_MAX_BATCH messages) and write them in one transaction
+CHAT_GROUP_COMMIT = os.environ.get('CHAT_GROUP_COMMIT', 'False') == 'True'
+CHAT_GROUP_COMMIT_WINDOW_MS = int(os.environ.get('CHAT_GROUP_COMMIT_WINDOW_MS', '5'))
+CHAT_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('CHAT_GROUP_COMMIT_MAX_BATCH', '100'))
+
+# Typing indicators: a "typing" state expires after CHAT_TYPING_TTL_SECONDS
+# without a refresh, and each user's state changes are published at most
+# once per CHAT_TYPING_WINDOW_MS
+CHAT_TYPING_TTL_SECONDS = 6
+CHAT_TYPING_WINDOW_MS = 1000
+
+# Offer MessagePack frames to clients requesting the "chat.msgpack" WebSocket
+# subprotocol (plain JSON clients are unaffected)
+CHAT_MSGPACK_ENABLED = True
+
+# Full-text message search. None picks the backend from the database vendor
+# (SQLite FTS5 or PostgreSQL tsvector); set a dotted path to override it.
+CHAT_SEARCH_BACKEND = None
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 100
+
+# Tiered storage: `manage.py archive_messages` moves messages older than
+# CHAT_ARCHIVE_AFTER_DAYS into compressed segments of CHAT_ARCHIVE_SEGMENT_SIZE
+# messages; history reads fall through to them transparently
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_SEGMENT_SIZE = 500
+
+# Consumer database calls run on one shared thread by default, which suits
+# SQLite's single writer. With a server database they run on a pool of
+# CHAT_DB_POOL_SIZE threads, each holding one persistent connection, so the
+# threads double as the connection pool. Daphne sizes its own default
+# executor from the same ASGI_THREADS environment variable.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '8'))
+CHAT_DB_POOL_SIZE = ASGI_THREADS if DATABASES['default']['ENGINE'].endswith('postgresql') else None
+
+# Hot-path counters and latency histograms, served on /metrics in the
+# Prometheus text format to scrapers presenting CHAT_METRICS_TOKEN as a bearer
+# token (and to staff users). Disabling turns all instrumentation into no-ops.
+CHAT_METRICS_ENABLED = os.environ.get('CHAT_METRICS_ENABLED', 'True') == 'True'
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN') or None
+
+# Presence: online sessions live in Redis when REDIS_URL is set (shared by
+# all workers), otherwise in process memory. A session expires
+# CHAT_PRESENCE_TTL_SECONDS after its last heartbeat (expired sessions are
+# swept and announced as offline once per TTL), each user's status
+# change is broadcast at most once per CHAT_PRESENCE_BROADCAST_WINDOW_SECONDS
+# and last-seen times are written in batches every CHAT_PRESENCE_FLUSH_SECONDS
+CHAT_PRESENCE_BACKEND = 'redis' if REDIS_URL else 'memory'
+CHAT_PRESENCE_REDIS_URL = REDIS_URL
+CHAT_PRESENCE_TTL_SECONDS = 60
+CHAT_PRESENCE_BROADCAST_WINDOW_SECONDS = 5
+CHAT_PRESENCE_FLUSH_SECONDS = 30
+
+# Backpressure: each socket may send CHAT_INBOUND_RATE frames per second on
+# average (bursts of CHAT_INBOUND_BURST); extra frames are dropped. A socket
+# whose fan-out events are older than CHAT_SHED_LAG_SECONDS, or queue up past
+# CHAT_SHED_QUEUE_DEPTH, drops typing, read and presence events; after
+# CHAT_SLOW_CONSUMER_SECONDS of that it is closed (code 4008).
+CHAT_INBOUND_RATE = 10
+CHAT_INBOUND_BURST = 30
+CHAT_SHED_LAG_SECONDS = 2
+CHAT_SHED_QUEUE_DEPTH = CHANNEL_CAPACITY // 4
+CHAT_SLOW_CONSUMER_SECONDS = 10
+
+# "New chat" user picker: username prefix search over an index on
+# UPPER(username); pages are cached for CHAT_USER_SEARCH_CACHE_SECONDS
+CHAT_USER_SEARCH_PAGE_SIZE = 20
+CHAT_USER_SEARCH_MAX_PAGE_SIZE = 50
+CHAT_USER_SEARCH_CACHE_SECONDS = 60
+
+# Group chats: a group's sockets are spread over CHAT_GROUP_FANOUT_SHARDS
+# channel-layer groups (change only with every server restarted at once).
+# With CHAT_FANOUT_CHANNEL set, senders hand the shard sends to
+# `manage.py runworker <channel>` processes instead of doing them inline.
+# Member lists are served in pages of CHAT_MEMBERS_PAGE_SIZE.
+CHAT_GROUP_FANOUT_SHARDS = 16
+CHAT_FANOUT_CHANNEL = os.environ.get('CHAT_FANOUT_CHANNEL') or None
+CHAT_MEMBERS_PAGE_SIZE = 100
+CHAT_MEMBERS_MAX_PAGE_SIZE = 500
+
+# Cache: shared Redis when REDIS_URL is set, otherwise a per-process LRU
+# (enough for a single server process only - cached pages are invalidated in
+# the process that handled the write). Sessions are read through the cache.
+# The conversation list and chat room fragments are cached per user until a
+# write invalidates them, and at most CHAT_PAGE_CACHE_SECONDS.
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+CHAT_PAGE_CACHE_SECONDS = 600
+
+# Attachments: files of up to CHAT_ATTACHMENT_MAX_BYTES are uploaded in chunks
+# of at most CHAT_UPLOAD_CHUNK_MAX_BYTES and stored once per distinct content
+# under MEDIA_ROOT/attachments; thumbnails are made by a background task.
+# With CHAT_MEDIA_ACCEL_REDIRECT set to an nginx `internal` location aliased
+# to MEDIA_ROOT, nginx sends the file bytes.
+CHAT_ATTACHMENT_MAX_BYTES = 100 * 1024 * 1024
+CHAT_UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+CHAT_THUMBNAIL_SIZE = 320
+CHAT_MEDIA_ACCEL_REDIRECT = os.environ.get('CHAT_MEDIA_ACCEL_REDIRECT') or None
+
+# Background tasks (search indexing, thumbnails) run on CHAT_TASK_WORKERS
+# threads per process (0 runs them inline) from a queue of at most
+# CHAT_TASK_QUEUE_SIZE; failures are retried CHAT_TASK_MAX_RETRIES times
+# after CHAT_TASK_RETRY_DELAY seconds, doubling each time. With
+# CHAT_TASKS_DURABLE=True tasks are stored in the database in the same
+# transaction as the write that needs them, and also processed by
+# `manage.py run_chat_tasks`.
+CHAT_TASK_WORKERS = int(os.environ.get('CHAT_TASK_WORKERS', '2'))
+CHAT_TASK_QUEUE_SIZE = 1000
+CHAT_TASK_MAX_RETRIES = 3
+CHAT_TASK_RETRY_DELAY = 1.0
+CHAT_TASKS_DURABLE = os.environ.get('CHAT_TASKS_DURABLE', 'False') == 'True'
+CHAT_TASK_POLL_SECONDS = 1.0
+CHAT_TASK_LEASE_SECONDS = 300
+
+# Retried chat_message frames carrying the same client_id are answered from a
+# per-process window of recent sends, falling back to a unique constraint on
+# (conversation, sender, client_id)
+CHAT_SEND_DEDUP_SECONDS = 300
+CHAT_SEND_DEDUP_MAX_ENTRIES = 10000